@@ -1,4 +1,3 @@
-import pytorch_lightning as pl
 from torch import nn
 import torch
 
@@ -8,15 +8,17 @@ class DeepLabModel(nn.Module):
     Args:
         num_classes (int): Number of outputs of model
         backbone (str, optional): Backbone to be used in model. Defaults to "resnet101".
+        encoder_weights (str, optional): Pretrained weights of the backbone, None to
+            skip downloading them. Defaults to "imagenet".
     """
-    def __init__(self, num_classes, backbone="resnet101"):
+    def __init__(self, num_classes, backbone="resnet101", encoder_weights="imagenet"):
         super().__init__()
 
         self.model = DeepLabV3Plus(
             encoder_name=backbone,
             classes=num_classes,
             in_channels=3,
-            # encoder_weights="imagenet"
+            encoder_weights=encoder_weights,
         )
 
     def forward(self, x):
@@ -0,0 +1,231 @@
+"""Static post-training INT8 quantization of the segmentation model for CPU serving.
+
+The ResNet encoder, which does most of the work of DeepLabV3+, is quantized with FX graph
+mode quantization and calibrated on the training split of the NL and France datasets.
+The quantized model is compared with the FP32 model on the test split, and saved as a
+TorchScript module that the server loads with SEGMENTATION_BACKEND=int8.
+
+Run from the root of the repository:
+
+    python -m pv_segmentation.quantize --checkpoint server/segmentation_model.ckpt
+"""
+
+import argparse
+import copy
+import os
+import time
+
+import torch
+import torch.utils.data as Data
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+from torch.utils.data import DataLoader
+from torchmetrics.classification import BinaryJaccardIndex
+from sklearn.model_selection import train_test_split
+
+from models.base import BaseModel
+from losses import LossJaccard
+from pv_segmentation.dataloaders.nl_dataset import NLSegmentationDataset
+from pv_segmentation.dataloaders.france_dataset import FranceDataset
+
+
+def load_splits(nl_folder: str, france_folder: str) -> tuple:
+    """Build the calibration and test sets with the same splits as the training script.
+
+    Args:
+        nl_folder (str): The folder of the NL Solar Panel segmentation dataset.
+        france_folder (str): The folder of the France dataset.
+
+    Returns:
+        tuple: The calibration and the test dataset.
+    """
+
+    france_dataset = FranceDataset(france_folder)
+
+    # Same split as train.py and test.py, so the test images were never calibrated on
+    train_indices, test_indices = train_test_split(
+        range(len(france_dataset)), test_size=0.2, random_state=0
+    )
+
+    calibration_dataset = Data.ConcatDataset(
+        [
+            Data.Subset(france_dataset, train_indices),
+            NLSegmentationDataset(image_dir=os.path.join(nl_folder, "train")),
+        ]
+    )
+    test_dataset = Data.ConcatDataset(
+        [
+            Data.Subset(france_dataset, test_indices),
+            NLSegmentationDataset(image_dir=os.path.join(nl_folder, "test")),
+        ]
+    )
+
+    return calibration_dataset, test_dataset
+
+
+def quantize(model: torch.nn.Module, loader: DataLoader, batches: int) -> torch.nn.Module:
+    """Quantize the encoder of the DeepLabV3+ model to INT8.
+
+    Args:
+        model (torch.nn.Module): The FP32 DeepLabV3+ model of segmentation_models_pytorch.
+        loader (DataLoader): The calibration images, shuffled.
+        batches (int): The number of batches used for calibration.
+
+    Returns:
+        torch.nn.Module: A copy of the model with a quantized encoder.
+    """
+
+    model = copy.deepcopy(model).eval()
+    example_inputs = (torch.zeros(1, 3, 640, 640),)
+
+    # Convolutions, batch norms and relus are fused while preparing
+    model.encoder = prepare_fx(
+        model.encoder,
+        get_default_qconfig_mapping(torch.backends.quantized.engine),
+        example_inputs,
+    )
+
+    # Record the activation ranges of the encoder
+    with torch.inference_mode():
+        for batch_idx, (X, _) in enumerate(loader):
+            if batch_idx == batches:
+                break
+
+            model(X)
+
+    model.encoder = convert_fx(model.encoder)
+
+    return model
+
+
+def evaluate(models: dict, loader: DataLoader, batches: int | None) -> dict:
+    """Compare the models on the test set, against the ground truth and against the
+    masks of the first model.
+
+    Args:
+        models (dict): The models by name, the first one is the reference.
+        loader (DataLoader): The test images.
+        batches (int | None): The number of batches evaluated, None for all of them.
+
+    Returns:
+        dict: The metrics and the latency per image of every model.
+    """
+
+    reference = next(iter(models))
+    jaccard = {name: BinaryJaccardIndex() for name in models}
+    agreement = {name: BinaryJaccardIndex() for name in models}
+    jaccard_loss = {name: 0.0 for name in models}
+    seconds = {name: 0.0 for name in models}
+    images = 0
+
+    loss_fn = LossJaccard()
+
+    with torch.inference_mode():
+        for batch_idx, (X, y) in enumerate(loader):
+            if batch_idx == batches:
+                break
+
+            masks = {}
+            for name, model in models.items():
+                start = time.perf_counter()
+                y_hat = model(X)
+                seconds[name] += time.perf_counter() - start
+
+                masks[name] = (torch.sigmoid(y_hat) > 0.5).int()
+                jaccard[name].update(masks[name], y.int())
+                agreement[name].update(masks[name], masks[reference])
+                jaccard_loss[name] += float(loss_fn(y_hat, y)) * len(X)
+
+            images += len(X)
+
+    return {
+        name: {
+            "jaccard": float(jaccard[name].compute()),
+            "jaccard_loss": jaccard_loss[name] / images,
+            f"jaccard_vs_{reference}": float(agreement[name].compute()),
+            "ms_per_image": seconds[name] / images * 1000,
+        }
+        for name in models
+    }
+
+
+def model_size(model: torch.nn.Module) -> int:
+    """Count the bytes of the weights and buffers of a model, including the packed
+    weights of the quantized layers.
+
+    Args:
+        model (torch.nn.Module): The model.
+
+    Returns:
+        int: The size of the state dict in bytes.
+    """
+
+    return sum(
+        tensor.numel() * tensor.element_size()
+        for tensor in model.state_dict().values()
+        if isinstance(tensor, torch.Tensor)
+    )
+
+
+def main(args):
+    torch.backends.quantized.engine = args.engine
+    torch.set_num_threads(args.threads)
+
+    base_model = BaseModel.load_from_checkpoint(args.checkpoint, map_location="cpu")
+
+    # BaseModel wraps a DeepLabModel, which wraps the DeepLabV3Plus of smp
+    fp32_model = base_model.model.model.eval()
+
+    calibration_dataset, test_dataset = load_splits(args.nl_folder, args.france_folder)
+
+    calibration_loader = DataLoader(
+        calibration_dataset,
+        batch_size=args.batch_size,
+        shuffle=True,
+        generator=torch.Generator().manual_seed(0),
+        num_workers=4,
+    )
+    test_loader = DataLoader(
+        test_dataset,
+        batch_size=args.batch_size,
+        shuffle=False,
+        num_workers=4,
+    )
+
+    int8_model = quantize(fp32_model, calibration_loader, args.calibration_batches)
+
+    report = evaluate(
+        {"fp32": fp32_model, "int8": int8_model}, test_loader, args.test_batches
+    )
+
+    for name, metrics in report.items():
+        print(name, ", ".join(f"{key}={value:.4f}" for key, value in metrics.items()))
+
+    print(
+        f"jaccard loss increase: "
+        f"{report['int8']['jaccard_loss'] - report['fp32']['jaccard_loss']:+.4f}, "
+        f"size: {model_size(fp32_model) / 2**20:.1f} MB -> "
+        f"{model_size(int8_model) / 2**20:.1f} MB"
+    )
+
+    # The server only ever feeds 640x640 tiles, so the traced graph is fixed to that size
+    with torch.no_grad():
+        traced = torch.jit.trace(int8_model, torch.zeros(1, 3, 640, 640))
+
+    torch.jit.save(torch.jit.freeze(traced), args.output)
+
+    print(f"Saved the INT8 model to {args.output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Quantize the segmentation model")
+    parser.add_argument("--checkpoint", type=str, default="segmentation_model.ckpt")
+    parser.add_argument("--output", type=str, default="segmentation_model_int8.pt")
+    parser.add_argument("--nl_folder", type=str, default="data/NL-Solar-Panel-Seg-1")
+    parser.add_argument("--france_folder", type=str, default="data/bdappv")
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--calibration_batches", type=int, default=32)
+    parser.add_argument("--test_batches", type=int, default=None)
+    parser.add_argument("--engine", type=str, default="x86")
+    parser.add_argument("--threads", type=int, default=os.cpu_count())
+    main(parser.parse_args())
@@ -0,0 +1,204 @@
+import os
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import Iterator, Tuple
+
+import numpy as np
+import torch
+
+from server import geo
+from server.executors import run_cpu
+from server.google_maps_api import ZOOM, IMAGE_SIZE, fetch_google_maps_static_image
+from server.inference import batched_segmentation_mask, postprocess_mask
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of tiles a single area request may cover
+SEGMENTATION_AREA_MAX_TILES = int(os.getenv("SEGMENTATION_AREA_MAX_TILES", 64))
+# Pixels of context every tile has around the region it contributes to the area
+SEGMENTATION_AREA_OVERLAP = int(os.getenv("SEGMENTATION_AREA_OVERLAP", 64))
+
+
+@dataclass(frozen=True)
+class TileGrid:
+    """Overlapping tiles covering an area, in global pixel coordinates at ZOOM. Every
+    pixel of the area is owned by exactly one tile, which sees at least overlap pixels of
+    context around it, so panels crossing the edge of a tile are predicted whole.
+
+    Args:
+        left (int): The x coordinate of the left edge of the area.
+        top (int): The y coordinate of the top edge of the area.
+        width (int): The width of the area in pixels.
+        height (int): The height of the area in pixels.
+        overlap (int): The pixels of context on each side of the owned region of a tile.
+    """
+
+    left: int
+    top: int
+    width: int
+    height: int
+    overlap: int
+
+    @classmethod
+    def from_bounds(
+        cls, south: float, west: float, north: float, east: float, overlap: int
+    ) -> "TileGrid":
+        left, top = geo.lat_lng_to_pixels(north, west, ZOOM)
+        right, bottom = geo.lat_lng_to_pixels(south, east, ZOOM)
+
+        left, top = int(np.floor(left)), int(np.floor(top))
+
+        return cls(
+            left=left,
+            top=top,
+            width=int(np.ceil(right)) - left,
+            height=int(np.ceil(bottom)) - top,
+            overlap=overlap,
+        )
+
+    @property
+    def stride(self) -> int:
+        # The owned region of a tile, tiles are placed this far apart
+        return IMAGE_SIZE - 2 * self.overlap
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return -(-self.height // self.stride), -(-self.width // self.stride)
+
+    def __len__(self) -> int:
+        rows, columns = self.shape
+        return rows * columns
+
+    def tiles(self) -> Iterator[Tuple[int, int]]:
+        rows, columns = self.shape
+
+        for row in range(rows):
+            for column in range(columns):
+                yield row, column
+
+    def center(self, row: int, column: int) -> str:
+        """The center of a tile, in the format of the Static Maps API."""
+
+        x = self.left + column * self.stride + self.stride // 2
+        y = self.top + row * self.stride + self.stride // 2
+        lat, lng = geo.pixels_to_lat_lng(x, y, ZOOM)
+
+        # 7 decimals keep the tile aligned to the pixel grid at zoom 20
+        return f"{lat:.7f},{lng:.7f}"
+
+    def origin(self, row: int, column: int) -> Tuple[int, int]:
+        """The global pixel coordinates of the top left corner of a tile."""
+
+        return (
+            self.left + column * self.stride - self.overlap,
+            self.top + row * self.stride - self.overlap,
+        )
+
+    def owns(self, row: int, column: int, x: float, y: float) -> bool:
+        """Whether a pixel of a tile lies in the region of the area owned by the tile.
+
+        Args:
+            row (int): The row of the tile.
+            column (int): The column of the tile.
+            x (float): The x coordinate within the tile.
+            y (float): The y coordinate within the tile.
+
+        Returns:
+            bool: Whether the tile owns the pixel.
+        """
+
+        # Coordinates within the area
+        x = column * self.stride + x - self.overlap
+        y = row * self.stride + y - self.overlap
+
+        return (
+            column * self.stride <= x < min((column + 1) * self.stride, self.width)
+            and row * self.stride <= y < min((row + 1) * self.stride, self.height)
+        )
+
+    def paste(self, canvas: np.ndarray, tile: np.ndarray, row: int, column: int):
+        """Copy the region owned by a tile into the canvas of the area.
+
+        Args:
+            canvas (np.ndarray): The canvas of the area, of shape HxW or HxWxC.
+            tile (np.ndarray): The tile, of shape 640x640 or 640x640xC.
+            row (int): The row of the tile.
+            column (int): The column of the tile.
+        """
+
+        y = row * self.stride
+        x = column * self.stride
+        height = min(self.stride, self.height - y)
+        width = min(self.stride, self.width - x)
+
+        canvas[y : y + height, x : x + width] = tile[
+            self.overlap : self.overlap + height, self.overlap : self.overlap + width
+        ]
+
+
+def build_area_panels(
+    origin: Tuple[int, int], polygons: list, centers: list, pvtypes: list
+) -> list:
+    """Convert the segmentation output of an image on the global pixel grid into panels
+    with real world coordinates.
+
+    Args:
+        origin (Tuple[int, int]): The global pixel coordinates of the top left corner of
+            the image.
+        polygons (list): The polygons in image pixel coordinates.
+        centers (list): The centers of the polygons in image pixel coordinates.
+        pvtypes (list): The pv type of each polygon.
+
+    Returns:
+        list: The panels with their polygon, center, area in m² and type.
+    """
+
+    polygons, centers, areas = geo.project_polygons(origin, polygons, centers, ZOOM)
+
+    return [
+        {
+            "polygon": polygon.tolist(),
+            "center": center.tolist(),
+            "area": float(area),
+            "type": pvtype,
+        }
+        for polygon, center, area, pvtype in zip(polygons, centers, areas, pvtypes)
+    ]
+
+
+def postprocess_area(grid: TileGrid, image: np.ndarray, mask: np.ndarray) -> list:
+    polygons, centers, pvtypes = postprocess_mask(image, torch.from_numpy(mask))
+
+    return build_area_panels((grid.left, grid.top), polygons, centers, pvtypes)
+
+
+async def segment_area(grid: TileGrid) -> list:
+    """Segment every tile of an area and merge the masks before extracting the panels,
+    so panels crossing the edge of a tile are returned once and whole.
+
+    Args:
+        grid (TileGrid): The tiles of the area.
+
+    Returns:
+        list: The panels in the area.
+    """
+
+    image = np.zeros((grid.height, grid.width, 3), dtype=np.uint8)
+    mask = np.zeros((grid.height, grid.width), dtype=np.uint8)
+
+    async def segment_tile(row: int, column: int):
+        tile = await fetch_google_maps_static_image(grid.center(row, column))
+
+        # The batcher stacks the tiles of the area into a few large forward passes
+        tile_mask = await batched_segmentation_mask(tile)
+
+        # Tiles own disjoint regions, so they are pasted without any locking
+        grid.paste(image, tile, row, column)
+        grid.paste(mask, tile_mask.numpy().astype(np.uint8), row, column)
+
+    await asyncio.gather(*(segment_tile(row, column) for row, column in grid.tiles()))
+
+    logger.info(f"Segmented an area of {len(grid)} tiles")
+
+    return await run_cpu(postprocess_area, grid, image, mask)
@@ -0,0 +1,77 @@
+"""Compare the latency of EnergyPredictionModel.predict with the compiled engines.
+
+Run from the server folder, next to the trained model:
+
+    python -m server.benchmark_energy_prediction --batch-size 2
+"""
+
+import argparse
+import timeit
+
+import numpy as np
+import torch
+
+from server.energy_prediction_model import compile_energy_prediction_model
+from server.energy_runtime import NumpyEnergyModel
+from server.export_models import load_energy_prediction_model
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--checkpoint", default="energy_prediction_model.pth")
+    parser.add_argument("--dataset-values", default="dataset_values.pkl")
+    parser.add_argument("--batch-size", type=int, default=2)
+    parser.add_argument("--iterations", type=int, default=1000)
+    parser.add_argument(
+        "--npz", help="also time the NumPy runtime with the weights in this file"
+    )
+    args = parser.parse_args()
+
+    torch.set_num_threads(1)
+
+    model = load_energy_prediction_model(args.checkpoint, args.dataset_values)
+    engine = compile_energy_prediction_model(model)
+
+    rng = np.random.default_rng(0)
+    dynamic = rng.random((args.batch_size, 24, 5), dtype=np.float32)
+    static = np.stack(
+        [
+            rng.uniform(0, 60, args.batch_size),
+            rng.uniform(0, 360, args.batch_size),
+            rng.integers(0, 2, args.batch_size),
+        ],
+        axis=1,
+    ).astype(np.float32)
+
+    def run_engine():
+        with torch.inference_mode():
+            return engine(torch.from_numpy(dynamic), torch.from_numpy(static))
+
+    # Both paths have to agree before their speed means anything
+    expected = model.predict(dynamic, static)
+    actual = run_engine()
+    print(f"max abs difference: {(expected - actual).abs().max().item():.2e}")
+
+    # The first calls of a frozen module run the profiling executor
+    for _ in range(10):
+        run_engine()
+
+    runs = [
+        ("predict", lambda: model.predict(dynamic, static)),
+        ("engine", run_engine),
+    ]
+
+    if args.npz:
+        numpy_model = NumpyEnergyModel.load(args.npz)
+        difference = np.abs(expected.numpy() - numpy_model(dynamic, static)).max()
+        print(f"max abs difference of the NumPy runtime: {difference:.2e}")
+
+        runs.append(("numpy", lambda: numpy_model(dynamic, static)))
+
+    for name, fn in runs:
+        seconds = min(timeit.repeat(fn, number=args.iterations, repeat=5))
+        print(f"{name:>8}: {seconds / args.iterations * 1e6:8.1f} us per call")
+
+
+if __name__ == "__main__":
+    main()
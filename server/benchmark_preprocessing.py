@@ -0,0 +1,102 @@
+"""Compare the latency and the allocations of the segmentation preprocessing paths.
+
+The "compose" path is the preprocessing the server used to run: a transform pipeline built
+for every image, which scales, resizes and normalizes into new tensors that are stacked
+into a batch. The "buffer" path is the Preprocessor of inference.py.
+
+Run from the root of the repository:
+
+    python -m server.benchmark_preprocessing --batch-size 8
+"""
+
+import argparse
+import timeit
+
+import numpy as np
+import torch
+import torchvision.transforms.v2 as transforms
+from torch.profiler import ProfilerActivity, profile
+
+from server.inference import IMAGENET_MEAN, IMAGENET_STD, Preprocessor
+
+
+def compose_preprocessing(images: list) -> torch.Tensor:
+    batch = []
+
+    for image in images:
+        transform = transforms.Compose(
+            [
+                transforms.ToImage(),
+                transforms.ToDtype(torch.float32, scale=True),
+                transforms.Resize(
+                    (640, 640), interpolation=transforms.InterpolationMode.NEAREST
+                ),
+                transforms.Normalize(mean=IMAGENET_MEAN, std=IMAGENET_STD),
+            ]
+        )
+        batch.append(transform(image))
+
+    return torch.stack(batch)
+
+
+def allocated_bytes(fn) -> tuple:
+    """Profile a single call and count the cpu memory allocated by its operators.
+
+    Returns:
+        tuple: The number of allocations and the number of bytes allocated.
+    """
+
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as profiler:
+        fn()
+
+    allocations = [
+        event.cpu_memory_usage
+        for event in profiler.events()
+        if event.cpu_memory_usage > 0 and event.name == "[memory]"
+    ]
+
+    return len(allocations), sum(allocations)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument(
+        "--size", type=int, default=640, help="side of the images, 640 skips the resize"
+    )
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--threads", type=int, default=1)
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+
+    rng = np.random.default_rng(0)
+    images = [
+        rng.integers(0, 256, (args.size, args.size, 3), dtype=np.uint8)
+        for _ in range(args.batch_size)
+    ]
+
+    preprocessor = Preprocessor(args.batch_size)
+
+    # Both paths have to agree before their speed means anything
+    expected = compose_preprocessing(images)
+    actual = preprocessor(images)
+    print(f"max abs difference: {(expected - actual).abs().max().item():.2e}")
+
+    runs = [
+        ("compose", lambda: compose_preprocessing(images)),
+        ("buffer", lambda: preprocessor(images)),
+    ]
+
+    for name, fn in runs:
+        seconds = min(timeit.repeat(fn, number=args.iterations, repeat=5))
+        allocations, size = allocated_bytes(fn)
+
+        print(
+            f"{name:>8}: {seconds / args.iterations * 1e3:7.2f} ms per batch, "
+            f"{allocations} allocations of {size / 2**20:.1f} MB per batch"
+        )
+
+
+if __name__ == "__main__":
+    main()
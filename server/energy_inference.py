@@ -0,0 +1,168 @@
+from typing import List
+import os
+import logging
+
+import numpy as np
+
+from server.energy_runtime import NumpyEnergyModel
+
+logger = logging.getLogger(__name__)
+
+# "torch" runs the compiled torch model, "numpy" runs the exported weights without torch
+ENERGY_MODEL_RUNTIME = os.getenv("ENERGY_MODEL_RUNTIME", "torch")
+# Weights written by "python -m server.export_models energy-npz"
+ENERGY_MODEL_NPZ = os.getenv("ENERGY_MODEL_NPZ", "energy_prediction_model.npz")
+# Weights and dataset values of the torch runtime, written by
+# "python -m server.export_models energy-artifact"
+ENERGY_MODEL_ARTIFACT = os.getenv(
+    "ENERGY_MODEL_ARTIFACT", "energy_prediction_model.safetensors"
+)
+
+energy_prediction_engine = None
+
+
+def load_torch_engine():
+    """Compile the trained torch model into an engine that takes and returns arrays."""
+
+    # Only imported here, so workers on the NumPy runtime never load torch
+    import pickle
+
+    import torch
+
+    from server.energy_prediction_model import (
+        EnergyPredictionModel,
+        compile_energy_prediction_model,
+    )
+    from server.model_artifacts import load_energy_prediction_artifact
+
+    if os.path.exists(ENERGY_MODEL_ARTIFACT):
+        energy_prediction_model = load_energy_prediction_artifact(
+            ENERGY_MODEL_ARTIFACT
+        )
+    else:
+        logger.warning(
+            f"{ENERGY_MODEL_ARTIFACT} not found, loading the energy prediction model "
+            "from its state dict and dataset values"
+        )
+
+        # Load the dataset values
+        with open("dataset_values.pkl", "rb") as f:
+            dataset_values = pickle.load(f)
+
+        # Load the energy prediction model
+        # dynamic feature size =5, static feature_size =3. Hidden /fc_size is 8/128
+        energy_prediction_model = EnergyPredictionModel(
+            dynamic_feature_size=5,
+            static_feature_size=3,
+            hidden_size=8,
+            fc_size=128,
+            dataset_values=dataset_values,
+        )
+        energy_prediction_model.load_state_dict(
+            torch.load("energy_prediction_model.pth")
+        )
+        energy_prediction_model.eval()
+
+    # The model is tiny, so it stays on the cpu where a call does not pay for transfers
+    compiled = compile_energy_prediction_model(energy_prediction_model)
+
+    def engine(dynamic_features: np.ndarray, static_features: np.ndarray) -> np.ndarray:
+        # The compiled engine reads the arrays in place and normalises them itself
+        with torch.inference_mode():
+            return compiled(
+                torch.from_numpy(dynamic_features), torch.from_numpy(static_features)
+            ).numpy()
+
+    return engine
+
+
+def load_energy_model():
+    """Load the energy prediction model on the runtime selected by ENERGY_MODEL_RUNTIME."""
+
+    global energy_prediction_engine
+
+    if ENERGY_MODEL_RUNTIME == "numpy":
+        energy_prediction_engine = NumpyEnergyModel.load(ENERGY_MODEL_NPZ)
+    else:
+        energy_prediction_engine = load_torch_engine()
+
+    logger.info(f"Energy prediction model loaded on the {ENERGY_MODEL_RUNTIME} runtime")
+
+
+def unload_energy_model():
+    global energy_prediction_engine
+
+    energy_prediction_engine = None
+
+
+MODULE_TYPES = {
+    "monocrystalline": 0,
+    "polycrystalline": 1,
+}
+
+
+def energy_prediction_batch(
+    dynamic_features: np.ndarray, static_features: np.ndarray
+) -> np.ndarray:
+    """Predict the energy output of many panels in a single forward pass.
+
+    Args:
+        dynamic_features (np.ndarray): The forecast features per panel and day, of shape
+            BxDx24x5
+        static_features (np.ndarray): The tilt, azimuth and module type of every panel,
+            of shape Bx3
+
+    Returns:
+        np.ndarray: The predicted output for each hour of each day, of shape BxDx24
+    """
+
+    panels, days = dynamic_features.shape[:2]
+
+    # Column order
+    # sample dynamics = Nx24x5 and sample static is Nx3 with tilt, azimuth, module_type
+    sample_dynamic = np.ascontiguousarray(
+        dynamic_features.reshape(panels * days, *dynamic_features.shape[2:]),
+        dtype=np.float32,
+    )
+
+    # Every day of the forecast of a panel shares the static features of the panel
+    sample_static = np.repeat(static_features.astype(np.float32), days, axis=0)
+
+    predictions = energy_prediction_engine(sample_dynamic, sample_static)
+
+    return predictions.reshape(panels, days, -1)
+
+
+def static_features(roof: dict, module_type: str) -> list:
+    """The static features of the energy prediction model for a panel.
+
+    Args:
+        roof (dict): The tilt and azimuth of the roof
+        module_type (str): The type of the solar panel, one of MODULE_TYPES
+
+    Returns:
+        list: The tilt, azimuth and module type
+    """
+
+    return [roof["tilt"], roof["azimuth"], MODULE_TYPES[module_type]]
+
+
+def energy_prediction(
+    dynamic_features: np.ndarray, roof: dict, module_type: str
+) -> List[List[float]]:
+    """Predict the energy output for each day based on the given forecast and roof.
+
+    Args:
+        dynamic_features (np.ndarray): The forecast features per day, of shape Dx24x5
+        roof (dict): The tilt and azimuth of the roof
+        module_type (str): The type of the solar panel, one of MODULE_TYPES
+
+    Returns:
+        List[List[float]]: The predicted output for each hour for each day
+    """
+
+    predictions = energy_prediction_batch(
+        dynamic_features[None], np.array([static_features(roof, module_type)])
+    )
+
+    return predictions[0].tolist()
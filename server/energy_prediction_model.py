@@ -1,6 +1,5 @@
 import torch
 from torch import nn
-import pytorch_lightning as pl
 import numpy as np
 
 
@@ -105,151 +104,68 @@ class EnergyPredictionModel(nn.Module):
         self.max = dataset_values["output_maxs"]
 
 
-class TrainEnergyPrediction(pl.LightningModule):
-    def __init__(
-        self,
-        dynamic_feature_size,
-        static_feature_size,
-        hidden_size,
-        fc_size,
-        learning_rate,
-        loss_type="mse",
-        dataset_values=None,
-    ):
-        super().__init__()
-        self.save_hyperparameters()
-        self.model = EnergyPredictionModel(
-            dynamic_feature_size,
-            static_feature_size,
-            hidden_size,
-            fc_size,
-            dropout_rate=0.1,
-            dataset_values=dataset_values,
-        )
+class EnergyPredictionEngine(nn.Module):
+    """Inference wrapper around a trained EnergyPredictionModel. The normalisation of
+    the inputs and the denormalisation of the output are folded into buffers, so a call
+    is a single forward pass on the tensors it is given, without any copies.
+
+    Args:
+        model (EnergyPredictionModel): The trained model.
+    """
+
+    def __init__(self, model: EnergyPredictionModel):
+        super(EnergyPredictionEngine, self).__init__()
+        self.model = model
 
-        if loss_type == "mse":
-            self.loss_fn = nn.MSELoss(reduction="sum")
-        elif loss_type == "l1":
-            self.loss_fn = nn.L1Loss(reduction="sum")
-        elif loss_type == "huber":
-            self.loss_fn = nn.HuberLoss(reduction="sum", delta=1.0)
-        else:
-            raise ValueError("Unsupported loss type. Choose from 'mse', 'l1', 'nll'.")
-
-        self.train_losses = []
-        self.validation_losses = []
-        self.test_losses = []
-        self.train_auc = []
-        self.validation_auc = []
-        self.train_r2 = []
-        self.val_r2 = []
-        self.learning_rate = learning_rate
-
-    def forward(self, x_dynamic, x_static):
-        return self.model(x_dynamic, x_static)
-
-    def training_step(self, batch, batch_idx):
-        x_dynamic, x_static, y_true = batch
-
-        y_pred = self(x_dynamic, x_static)
-
-        train_loss = self.loss_fn(y_pred, y_true)
-        self.train_losses.append(train_loss.item())
-        sum_loss = nn.L1Loss(reduction="sum")(y_pred, y_true)
-
-        # Calculate AUC for predictions and ground truth
-        auc_pred = self.calculate_auc(y_pred)
-        auc_gt = self.calculate_auc(y_true)
-        auc_ratio = auc_pred / auc_gt if auc_gt != 0 else 0
-
-        self.train_auc.append(auc_ratio.item())
-
-        # Calculate R^2 score
-        r2 = self.r2_score(y_true, y_pred)
-        self.train_r2.append(r2.item())
-
-        # Log metrics
-        self.log("train_auc", auc_ratio, on_step=True, on_epoch=True, logger=True)
-        self.log("train_loss", train_loss, on_step=True, on_epoch=True, logger=True)
-        self.log("train_l1_sum", sum_loss, on_step=False, on_epoch=True, logger=True)
-        self.log("train_r2_score", r2, on_step=True, on_epoch=True)
-
-        return train_loss
-
-    def validation_step(self, batch, batch_idx):
-        x_dynamic, x_static, y_true = batch
-        y_pred = self(x_dynamic, x_static)
-        val_loss = self.loss_fn(y_pred, y_true)
-        self.validation_losses.append(val_loss.item())
-        val_eval_metric = nn.L1Loss(reduction="mean")(y_pred, y_true)
-
-        # Calculate AUC for predictions and ground truth
-        auc_pred = self.calculate_auc(y_pred)
-        auc_gt = self.calculate_auc(y_true)
-        auc_ratio = auc_pred / auc_gt if auc_gt != 0 else 0
-
-        self.validation_auc.append(auc_ratio.item())
-
-        # Calculate R^2 score
-        r2 = self.r2_score(y_true, y_pred)
-        self.val_r2.append(r2.item())
-
-        # Log metrics
-        self.log("validation_auc", auc_ratio, on_step=True, on_epoch=True, logger=True)
-        self.log("val_train_loss", val_loss, on_step=False, on_epoch=True, logger=True)
-        self.log(
-            "val_evaluation_metric",
-            val_eval_metric,
-            on_step=False,
-            on_epoch=True,
-            logger=True,
+        # The last static feature is the module type, which is not normalised
+        static_dim = model.fc1.in_features - model.dynamic_rnn1.hidden_size - 1
+
+        mean = [float(value) for value in model.mean]
+        std = [float(value) for value in model.std]
+
+        self.register_buffer(
+            "static_mean", torch.tensor(mean[:static_dim] + [0], dtype=torch.float32)
+        )
+        self.register_buffer(
+            "static_scale",
+            1 / torch.tensor(std[:static_dim] + [1], dtype=torch.float32),
         )
-        self.log("val_r2_score", r2, on_step=True, on_epoch=True)
-
-        return val_eval_metric
-
-    def test_step(self, batch, batch_idx, dataloader_idx=0):
-        x_dynamic, x_static, y_true = batch
-        y_pred = self(x_dynamic, x_static)
-        test_loss = self.loss_fn(y_pred, y_true)
-        sum_loss = nn.L1Loss(reduction="sum")(y_pred, y_true)
-
-        # Calculate AUC for predictions and ground truth
-        auc_pred = self.calculate_auc(y_pred)
-        auc_gt = self.calculate_auc(y_true)
-        auc_ratio = auc_pred / auc_gt if auc_gt != 0 else 0
-
-        # Calculate R^2 score
-        r2 = self.r2_score(y_true, y_pred)
-
-        # Log metrics
-        self.log(f"Total test_loss", test_loss)
-        self.log(f"Total L1 loss", sum_loss)
-        self.log(f"Total auc_ratio", auc_ratio)
-        self.log(
-            "test_r2_score",
-            r2,
+        self.register_buffer(
+            "dynamic_mean", torch.tensor(mean[static_dim:], dtype=torch.float32)
         )
-        self.test_losses.append(test_loss.item())
-
-        return {
-            "test_loss": test_loss,
-            "sum_l1_loss": sum_loss,
-            "auc_ratio": auc_ratio,
-            "test_r2_score": r2,
-        }
-
-    def configure_optimizers(self):
-        optimizer = torch.optim.Adam(self.model.parameters(), lr=self.learning_rate)
-        return optimizer
-
-    def calculate_auc(self, y_values):
-        y_values = y_values.detach().numpy()
-        auc = np.trapz(y_values, axis=1)
-        return np.mean(auc)
-
-    def r2_score(self, y_true, y_pred):
-        ss_res = torch.sum((y_true - y_pred) ** 2)
-        ss_tot = torch.sum((y_true - torch.mean(y_true)) ** 2)
-        r2 = 1 - ss_res / ss_tot
-        return r2
+        self.register_buffer(
+            "dynamic_scale", 1 / torch.tensor(std[static_dim:], dtype=torch.float32)
+        )
+
+        output_min = torch.as_tensor(np.asarray(model.min), dtype=torch.float32)
+        output_max = torch.as_tensor(np.asarray(model.max), dtype=torch.float32)
+
+        self.register_buffer("output_min", output_min)
+        self.register_buffer("output_range", output_max - output_min)
+
+    def forward(self, dynamic_features, static_features):
+        dynamic_features = (dynamic_features - self.dynamic_mean) * self.dynamic_scale
+        static_features = (static_features - self.static_mean) * self.static_scale
+
+        output = self.model(dynamic_features, static_features)
+
+        return output * self.output_range + self.output_min
+
+
+def compile_energy_prediction_model(
+    model: EnergyPredictionModel,
+) -> torch.jit.ScriptModule:
+    """Compile the model with its normalisation into a frozen TorchScript module. The
+    result takes float32 tensors of shape Bx24x5 and Bx3 and returns the denormalised
+    output of shape Bx24.
+
+    Args:
+        model (EnergyPredictionModel): The trained model.
+
+    Returns:
+        torch.jit.ScriptModule: The compiled model.
+    """
+
+    engine = EnergyPredictionEngine(model).eval()
+
+    return torch.jit.freeze(torch.jit.script(engine))
@@ -0,0 +1,96 @@
+import numpy as np
+
+
+def sigmoid(x: np.ndarray) -> np.ndarray:
+    # Written with tanh, which does not overflow for large negative inputs
+    return 0.5 * (1 + np.tanh(0.5 * x))
+
+
+class NumpyEnergyModel:
+    """NumPy implementation of the forward pass of the EnergyPredictionModel, including
+    the normalisation of the inputs and the denormalisation of the output. It loads the
+    weights written by export_models.py, so a worker that only serves predictions never
+    has to import torch.
+
+    Args:
+        weights (dict): The arrays of the exported model.
+    """
+
+    def __init__(self, weights: dict):
+        # Transposed once, so every step is a plain row major matrix product
+        self.weight_ih = np.ascontiguousarray(weights["lstm.weight_ih"].T)
+        self.weight_hh = np.ascontiguousarray(weights["lstm.weight_hh"].T)
+        self.bias = weights["lstm.bias_ih"] + weights["lstm.bias_hh"]
+        self.hidden_size = self.weight_hh.shape[0]
+
+        self.layers = [
+            (np.ascontiguousarray(weights[f"{name}.weight"].T), weights[f"{name}.bias"])
+            for name in ["fc1", "fc2", "fc3"]
+        ]
+
+        self.dynamic_mean = weights["dynamic_mean"]
+        self.dynamic_scale = weights["dynamic_scale"]
+        self.static_mean = weights["static_mean"]
+        self.static_scale = weights["static_scale"]
+        self.output_min = weights["output_min"]
+        self.output_range = weights["output_range"]
+
+    @classmethod
+    def load(cls, path: str) -> "NumpyEnergyModel":
+        with np.load(path) as weights:
+            return cls({name: weights[name].astype(np.float32) for name in weights})
+
+    def lstm(self, dynamic_features: np.ndarray) -> np.ndarray:
+        """Run the LSTM over the sequences and return the last hidden state.
+
+        Args:
+            dynamic_features (np.ndarray): The normalised sequences, of shape BxTxF.
+
+        Returns:
+            np.ndarray: The last hidden state, of shape BxH.
+        """
+
+        batch_size, steps, _ = dynamic_features.shape
+        hidden = np.zeros((batch_size, self.hidden_size), dtype=np.float32)
+        cell = np.zeros((batch_size, self.hidden_size), dtype=np.float32)
+
+        # The input projection of every step is computed in a single product
+        inputs = dynamic_features @ self.weight_ih + self.bias
+
+        for step in range(steps):
+            gates = inputs[:, step] + hidden @ self.weight_hh
+
+            # The gates are stacked in the order of torch: input, forget, cell, output
+            i, f, g, o = np.split(gates, 4, axis=1)
+
+            cell = sigmoid(f) * cell + sigmoid(i) * np.tanh(g)
+            hidden = sigmoid(o) * np.tanh(cell)
+
+        return hidden
+
+    def __call__(
+        self, dynamic_features: np.ndarray, static_features: np.ndarray
+    ) -> np.ndarray:
+        """Predict the energy output.
+
+        Args:
+            dynamic_features (np.ndarray): The forecast features, of shape Bx24x5.
+            static_features (np.ndarray): The tilt, azimuth and module type, of shape Bx3.
+
+        Returns:
+            np.ndarray: The predicted output for each hour, of shape Bx24.
+        """
+
+        dynamic_features = (dynamic_features - self.dynamic_mean) * self.dynamic_scale
+        static_features = (static_features - self.static_mean) * self.static_scale
+
+        x = np.concatenate([self.lstm(dynamic_features), static_features], axis=1)
+
+        for index, (weight, bias) in enumerate(self.layers):
+            x = x @ weight + bias
+
+            # ReLU between the layers, dropout is a no-op during inference
+            if index < len(self.layers) - 1:
+                np.maximum(x, 0, out=x)
+
+        return sigmoid(x) * self.output_range + self.output_min
@@ -0,0 +1,170 @@
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+import numpy as np
+
+# Number of threads running cpu bound work such as the model forward passes
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", 2))
+# Maximum number of upstream calls (Google, KNMI) that are in flight at the same time
+UPSTREAM_CONCURRENCY = int(os.getenv("UPSTREAM_CONCURRENCY", 16))
+
+cpu_executor = None
+io_limiter = None
+
+
+class QueueMetrics:
+    """Keeps track of how long work waits before it starts running.
+
+    Args:
+        window (int, optional): Number of recent waits used for the percentiles. Defaults to 1000.
+    """
+
+    def __init__(self, window: int = 1000):
+        self.lock = threading.Lock()
+        self.waits = deque(maxlen=window)
+        self.completed = 0
+        self.waiting = 0
+        self.running = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def enqueued(self):
+        with self.lock:
+            self.waiting += 1
+
+    def abandoned(self):
+        with self.lock:
+            self.waiting -= 1
+
+    def started(self, wait: float):
+        with self.lock:
+            self.waiting -= 1
+            self.running += 1
+            self.waits.append(wait)
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+
+    def finished(self):
+        with self.lock:
+            self.running -= 1
+            self.completed += 1
+
+    def snapshot(self) -> dict:
+        """Summarize the metrics, all the waiting times are in milliseconds.
+
+        Returns:
+            dict: The current metrics.
+        """
+
+        with self.lock:
+            waits = np.array(self.waits) * 1000
+            started = self.completed + self.running
+
+        return {
+            "waiting": self.waiting,
+            "running": self.running,
+            "completed": self.completed,
+            "mean_wait_ms": self.total_wait * 1000 / started if started else 0.0,
+            "p50_wait_ms": float(np.percentile(waits, 50)) if len(waits) else 0.0,
+            "p95_wait_ms": float(np.percentile(waits, 95)) if len(waits) else 0.0,
+            "max_wait_ms": self.max_wait * 1000,
+        }
+
+
+class BoundedExecutor:
+    """Thread pool with a fixed number of workers for cpu bound work, so that the
+    event loop stays responsive while the models are running.
+
+    Args:
+        name (str): The name of the executor, used for the thread names.
+        max_workers (int): The number of threads.
+    """
+
+    def __init__(self, name: str, max_workers: int):
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix=name
+        )
+        self.metrics = QueueMetrics()
+
+    async def run(self, fn, *args, **kwargs):
+        """Run the function on the executor and wait for the result."""
+
+        queued = time.perf_counter()
+        self.metrics.enqueued()
+
+        def job():
+            self.metrics.started(time.perf_counter() - queued)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.metrics.finished()
+
+        return await asyncio.get_running_loop().run_in_executor(self.executor, job)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class ConcurrencyLimiter:
+    """Limits the number of concurrent calls to upstream services.
+
+    Args:
+        max_concurrency (int): Maximum number of calls in flight.
+    """
+
+    def __init__(self, max_concurrency: int):
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.metrics = QueueMetrics()
+
+    @asynccontextmanager
+    async def slot(self):
+        """Wait for a free slot and hold it for the duration of the context."""
+
+        queued = time.perf_counter()
+        self.metrics.enqueued()
+
+        try:
+            await self.semaphore.acquire()
+        except BaseException:
+            self.metrics.abandoned()
+            raise
+
+        self.metrics.started(time.perf_counter() - queued)
+        try:
+            yield
+        finally:
+            self.metrics.finished()
+            self.semaphore.release()
+
+
+def load_executors():
+    global cpu_executor, io_limiter
+
+    cpu_executor = BoundedExecutor("inference", INFERENCE_WORKERS)
+    io_limiter = ConcurrencyLimiter(UPSTREAM_CONCURRENCY)
+
+
+def unload_executors():
+    global cpu_executor, io_limiter
+
+    cpu_executor.shutdown()
+    cpu_executor = None
+    io_limiter = None
+
+
+async def run_cpu(fn, *args, **kwargs):
+    """Run cpu bound work, such as model inference, on the bounded inference executor."""
+
+    return await cpu_executor.run(fn, *args, **kwargs)
+
+
+def executor_metrics() -> dict:
+    return {
+        "inference": cpu_executor.metrics.snapshot(),
+        "upstream": io_limiter.metrics.snapshot(),
+    }
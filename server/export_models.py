@@ -0,0 +1,393 @@
+"""Export the trained models to formats the server can run without their training code.
+
+Run from the server folder, next to the trained models:
+
+    python -m server.export_models energy-npz --output energy_prediction_model.npz
+    python -m server.export_models segmentation-onnx --output segmentation_model.onnx
+    python -m server.export_models energy-artifact
+    python -m server.export_models segmentation-artifact
+"""
+
+import argparse
+import pickle
+
+import numpy as np
+import torch
+from PIL import Image
+
+from server.energy_prediction_model import (
+    EnergyPredictionModel,
+    EnergyPredictionEngine,
+)
+from server.energy_runtime import NumpyEnergyModel
+from server.model_artifacts import (
+    load_energy_prediction_artifact,
+    load_segmentation_artifact,
+    save_artifact,
+)
+
+
+def load_energy_prediction_model(
+    checkpoint: str, dataset_values: str
+) -> EnergyPredictionModel:
+    with open(dataset_values, "rb") as f:
+        values = pickle.load(f)
+
+    model = EnergyPredictionModel(
+        dynamic_feature_size=5,
+        static_feature_size=3,
+        hidden_size=8,
+        fc_size=128,
+        dataset_values=values,
+    )
+    model.load_state_dict(torch.load(checkpoint))
+
+    return model.eval()
+
+
+def export_energy_npz(model: EnergyPredictionModel, path: str):
+    """Write the weights and the normalisation of the energy prediction model to an npz
+    file that can be loaded by NumpyEnergyModel.
+
+    Args:
+        model (EnergyPredictionModel): The trained model.
+        path (str): The path of the npz file.
+    """
+
+    # The engine already folds the dataset values into its buffers
+    state = {
+        name: tensor.detach().cpu().numpy().astype(np.float32)
+        for name, tensor in EnergyPredictionEngine(model).state_dict().items()
+    }
+
+    arrays = {
+        "lstm.weight_ih": state["model.dynamic_rnn1.weight_ih_l0"],
+        "lstm.weight_hh": state["model.dynamic_rnn1.weight_hh_l0"],
+        "lstm.bias_ih": state["model.dynamic_rnn1.bias_ih_l0"],
+        "lstm.bias_hh": state["model.dynamic_rnn1.bias_hh_l0"],
+        **{
+            f"{layer}.{parameter}": state[f"model.{layer}.{parameter}"]
+            for layer in ["fc1", "fc2", "fc3"]
+            for parameter in ["weight", "bias"]
+        },
+        **{
+            name: state[name]
+            for name in [
+                "dynamic_mean",
+                "dynamic_scale",
+                "static_mean",
+                "static_scale",
+                "output_min",
+                "output_range",
+            ]
+        },
+    }
+
+    np.savez(path, **arrays)
+
+
+def random_energy_inputs(samples: int) -> tuple:
+    rng = np.random.default_rng(0)
+    dynamic = rng.normal(size=(samples, 24, 5)).astype(np.float32)
+    static = np.stack(
+        [
+            rng.uniform(0, 60, samples),
+            rng.uniform(0, 360, samples),
+            rng.integers(0, 2, samples),
+        ],
+        axis=1,
+    ).astype(np.float32)
+
+    return dynamic, static
+
+
+def verify_energy_npz(model: EnergyPredictionModel, path: str, samples: int = 256):
+    """Compare the NumPy runtime with the torch model on random inputs.
+
+    Args:
+        model (EnergyPredictionModel): The trained model.
+        path (str): The path of the exported npz file.
+        samples (int): The number of random inputs.
+
+    Returns:
+        float: The largest absolute difference between the outputs.
+    """
+
+    dynamic, static = random_energy_inputs(samples)
+
+    expected = model.predict(dynamic, static).numpy()
+    actual = NumpyEnergyModel.load(path)(dynamic, static)
+
+    return float(np.abs(expected - actual).max())
+
+
+def export_energy_artifact(model: EnergyPredictionModel, path: str):
+    """Write the weights and the dataset values of the energy prediction model to a
+    safetensors artifact.
+
+    Args:
+        model (EnergyPredictionModel): The trained model.
+        path (str): The path of the safetensors file.
+    """
+
+    hidden_size = model.dynamic_rnn1.hidden_size
+
+    config = {
+        "dynamic_feature_size": model.dynamic_rnn1.input_size,
+        "static_feature_size": model.fc1.in_features - hidden_size,
+        "hidden_size": hidden_size,
+        "fc_size": model.fc2.out_features,
+        "dataset_values": {
+            "mean": [float(value) for value in model.mean],
+            "std": [float(value) for value in model.std],
+            "output_mins": np.asarray(model.min, dtype=np.float64).tolist(),
+            "output_maxs": np.asarray(model.max, dtype=np.float64).tolist(),
+        },
+    }
+
+    save_artifact(model, config, path)
+
+
+def verify_energy_artifact(model: EnergyPredictionModel, path: str, samples: int = 256):
+    """Compare the model loaded from the artifact with the trained model.
+
+    Args:
+        model (EnergyPredictionModel): The trained model.
+        path (str): The path of the safetensors file.
+        samples (int): The number of random inputs.
+
+    Returns:
+        float: The largest absolute difference between the outputs.
+    """
+
+    dynamic, static = random_energy_inputs(samples)
+
+    expected = model.predict(dynamic, static)
+    actual = load_energy_prediction_artifact(path).predict(dynamic, static)
+
+    return float((expected - actual).abs().max())
+
+
+def load_segmentation_checkpoint(checkpoint: str) -> torch.nn.Module:
+    # The segmentation imports are only needed by the segmentation commands
+    from models.base import BaseModel
+
+    # BaseModel only adds the training loop around the DeepLabModel
+    return BaseModel.load_from_checkpoint(checkpoint, map_location="cpu").model.eval()
+
+
+def export_segmentation_artifact(
+    checkpoint: str, path: str, num_classes: int, backbone: str
+) -> torch.nn.Module:
+    """Write the weights of the DeepLabModel of a BaseModel checkpoint to a safetensors
+    artifact, without the optimizer, the loss and the other hyperparameters.
+
+    Args:
+        checkpoint (str): The path of the BaseModel checkpoint.
+        path (str): The path of the safetensors file.
+        num_classes (int): The number of outputs of the model.
+        backbone (str): The encoder of the model.
+
+    Returns:
+        torch.nn.Module: The exported torch model.
+    """
+
+    model = load_segmentation_checkpoint(checkpoint)
+
+    save_artifact(model, {"num_classes": num_classes, "backbone": backbone}, path)
+
+    return model
+
+
+def verify_segmentation_artifact(model: torch.nn.Module, path: str) -> float:
+    """Compare the model loaded from the artifact with the checkpoint on random images.
+
+    Args:
+        model (torch.nn.Module): The DeepLabModel of the checkpoint.
+        path (str): The path of the safetensors file.
+
+    Returns:
+        float: The largest absolute difference between the logits.
+    """
+
+    images = torch.randn(2, 3, 640, 640, generator=torch.Generator().manual_seed(0))
+    artifact_model = load_segmentation_artifact(path, torch.device("cpu"))
+
+    with torch.inference_mode():
+        return float((model(images) - artifact_model(images)).abs().max())
+
+
+def export_segmentation_onnx(
+    checkpoint: str, path: str, opset: int = 17
+) -> torch.nn.Module:
+    """Export the segmentation model of a BaseModel checkpoint to ONNX. The batch size
+    is dynamic, the images are always 640x640.
+
+    Args:
+        checkpoint (str): The path of the BaseModel checkpoint.
+        path (str): The path of the ONNX model.
+        opset (int): The ONNX opset version.
+
+    Returns:
+        torch.nn.Module: The exported torch model.
+    """
+
+    model = load_segmentation_checkpoint(checkpoint)
+
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            torch.zeros(1, 3, 640, 640),
+            path,
+            input_names=["images"],
+            output_names=["logits"],
+            dynamic_axes={"images": {0: "batch"}, "logits": {0: "batch"}},
+            opset_version=opset,
+        )
+
+    return model
+
+
+def verify_segmentation_onnx(model: torch.nn.Module, path: str, fixture: str) -> bool:
+    """Check that the torch model and the ONNX model find the same polygons on an image.
+
+    Args:
+        model (torch.nn.Module): The torch segmentation model.
+        path (str): The path of the ONNX model.
+        fixture (str): The path of the image.
+
+    Returns:
+        bool: Whether the polygons, centers and pv types are identical.
+    """
+
+    # The segmentation imports are only needed by the segmentation commands
+    from server.inference import Preprocessor, postprocess_mask
+    from server.onnx_segmentation import OnnxSegmentationModel
+
+    rgb_image = np.asarray(Image.open(fixture).convert("RGB"))
+    image = Preprocessor(batch_size=1)([rgb_image])
+
+    with torch.inference_mode():
+        torch_logits = model(image)
+
+    onnx_logits = torch.from_numpy(OnnxSegmentationModel(path)(image.numpy()))
+
+    results = []
+    for logits in [torch_logits, onnx_logits]:
+        mask = (torch.sigmoid(logits) > 0.5).int().squeeze(1)
+        results.append(postprocess_mask(rgb_image, mask[0]))
+
+    torch_result, onnx_result = results
+    torch_polygons, torch_centers, torch_types = torch_result
+    onnx_polygons, onnx_centers, onnx_types = onnx_result
+
+    print(
+        f"torch found {len(torch_polygons)} polygons, onnx found {len(onnx_polygons)}, "
+        f"max abs logit difference {(torch_logits - onnx_logits).abs().max():.2e}"
+    )
+
+    return (
+        len(torch_polygons) == len(onnx_polygons)
+        and all(np.array_equal(a, b) for a, b in zip(torch_polygons, onnx_polygons))
+        and torch_centers == onnx_centers
+        and torch_types == onnx_types
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    energy_npz = commands.add_parser(
+        "energy-npz", help="energy prediction model for the NumPy runtime"
+    )
+    energy_npz.add_argument("--checkpoint", default="energy_prediction_model.pth")
+    energy_npz.add_argument("--dataset-values", default="dataset_values.pkl")
+    energy_npz.add_argument("--output", default="energy_prediction_model.npz")
+    energy_npz.add_argument("--tolerance", type=float, default=1e-4)
+
+    segmentation_onnx = commands.add_parser(
+        "segmentation-onnx", help="segmentation model for ONNX Runtime"
+    )
+    segmentation_onnx.add_argument("--checkpoint", default="segmentation_model.ckpt")
+    segmentation_onnx.add_argument("--output", default="segmentation_model.onnx")
+    segmentation_onnx.add_argument("--opset", type=int, default=17)
+    segmentation_onnx.add_argument(
+        "--fixture",
+        default="../pv_segmentation/imgs/eindhoven_satellite.png",
+        help="image on which both models have to find the same polygons",
+    )
+
+    energy_artifact = commands.add_parser(
+        "energy-artifact", help="energy prediction model for the torch runtime"
+    )
+    energy_artifact.add_argument("--checkpoint", default="energy_prediction_model.pth")
+    energy_artifact.add_argument("--dataset-values", default="dataset_values.pkl")
+    energy_artifact.add_argument(
+        "--output", default="energy_prediction_model.safetensors"
+    )
+    energy_artifact.add_argument("--tolerance", type=float, default=1e-6)
+
+    segmentation_artifact = commands.add_parser(
+        "segmentation-artifact", help="segmentation model without Lightning"
+    )
+    segmentation_artifact.add_argument(
+        "--checkpoint", default="segmentation_model.ckpt"
+    )
+    segmentation_artifact.add_argument(
+        "--output", default="segmentation_model.safetensors"
+    )
+    segmentation_artifact.add_argument("--num-classes", type=int, default=1)
+    segmentation_artifact.add_argument("--backbone", default="resnet101")
+    segmentation_artifact.add_argument("--tolerance", type=float, default=1e-5)
+
+    args = parser.parse_args()
+
+    if args.command == "energy-npz":
+        model = load_energy_prediction_model(args.checkpoint, args.dataset_values)
+        export_energy_npz(model, args.output)
+
+        # The output is denormalised, so the tolerance is relative to its range
+        difference = verify_energy_npz(model, args.output)
+        scale = float(np.abs(np.asarray(model.max)).max())
+
+        print(f"Wrote {args.output}, max abs difference {difference:.2e}")
+
+        if difference > args.tolerance * max(scale, 1):
+            raise SystemExit("The NumPy runtime does not match the torch model")
+
+    elif args.command == "segmentation-onnx":
+        model = export_segmentation_onnx(args.checkpoint, args.output, args.opset)
+
+        print(f"Wrote {args.output}")
+
+        if not verify_segmentation_onnx(model, args.output, args.fixture):
+            raise SystemExit("The ONNX model does not find the same polygons")
+
+    elif args.command == "energy-artifact":
+        model = load_energy_prediction_model(args.checkpoint, args.dataset_values)
+        export_energy_artifact(model, args.output)
+
+        difference = verify_energy_artifact(model, args.output)
+        scale = float(np.abs(np.asarray(model.max)).max())
+
+        print(f"Wrote {args.output}, max abs difference {difference:.2e}")
+
+        if difference > args.tolerance * max(scale, 1):
+            raise SystemExit("The artifact does not match the torch model")
+
+    elif args.command == "segmentation-artifact":
+        model = export_segmentation_artifact(
+            args.checkpoint, args.output, args.num_classes, args.backbone
+        )
+
+        difference = verify_segmentation_artifact(model, args.output)
+
+        print(f"Wrote {args.output}, max abs logit difference {difference:.2e}")
+
+        if difference > args.tolerance:
+            raise SystemExit("The artifact does not match the checkpoint")
+
+
+if __name__ == "__main__":
+    main()
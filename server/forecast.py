@@ -0,0 +1,341 @@
+import os
+import tempfile
+from dataclasses import dataclass, field
+
+import numpy as np
+import pandas as pd
+from pvlib import irradiance, solarposition
+from scipy.spatial import cKDTree
+
+# Fields of the forecast cube, temperature is in Celsius and the global radiation is
+# accumulated since the start of the run
+VARIABLES = ["temperature", "windSpeed", "globalRadiation"]
+
+# Order of the dynamic features expected by the energy prediction model
+DYNAMIC_FEATURES = [
+    "temperature_sequence",
+    "wind_speed_sequence",
+    "dni_sequence",
+    "dhi_sequence",
+    "global_irradiance_sequence",
+]
+
+
+class GridIndex:
+    """Spatial index over the grid of the HARMONIE model. On a regular lat/lon grid the
+    four surrounding grid points are computed directly and the fields are interpolated
+    bilinearly. Other grids fall back to the nearest grid point using a KD-tree.
+
+    Args:
+        lats (np.ndarray): The latitude of every grid point, of shape NjxNi.
+        lons (np.ndarray): The longitude of every grid point, of shape NjxNi.
+    """
+
+    def __init__(self, lats: np.ndarray, lons: np.ndarray):
+        self.lats = np.asarray(lats, dtype=np.float64)
+        self.lons = np.asarray(lons, dtype=np.float64)
+        self.shape = self.lats.shape
+
+        lat_axis = self.lats[:, 0]
+        lon_axis = self.lons[0, :]
+
+        self.regular = (
+            min(self.shape) > 1
+            and np.allclose(self.lats, lat_axis[:, None])
+            and np.allclose(self.lons, lon_axis[None, :])
+            and np.allclose(np.diff(lat_axis), lat_axis[1] - lat_axis[0])
+            and np.allclose(np.diff(lon_axis), lon_axis[1] - lon_axis[0])
+        )
+
+        if self.regular:
+            self.lat0, self.dlat = lat_axis[0], lat_axis[1] - lat_axis[0]
+            self.lon0, self.dlon = lon_axis[0], lon_axis[1] - lon_axis[0]
+            self.tree = None
+        else:
+            self.tree = cKDTree(np.column_stack([self.lats.ravel(), self.lons.ravel()]))
+
+    def weights(self, lat, lon) -> tuple:
+        """Find the grid points used for the locations and their weights.
+
+        Args:
+            lat: The latitude of the locations, a float or an array of shape N.
+            lon: The longitude of the locations, a float or an array of shape N.
+
+        Returns:
+            tuple: The flat indices of the grid points and their weights, of shape
+                (..., K) with K the number of grid points per location.
+        """
+
+        lat = np.asarray(lat, dtype=np.float64)
+        lon = np.asarray(lon, dtype=np.float64)
+
+        if not self.regular:
+            _, index = self.tree.query(np.stack([lat, lon], axis=-1))
+            index = np.asarray(index)[..., None]
+            return index, np.ones(index.shape)
+
+        ny, nx = self.shape
+
+        # Fractional position on the grid, locations outside the grid use the border
+        y = np.clip((lat - self.lat0) / self.dlat, 0, ny - 1)
+        x = np.clip((lon - self.lon0) / self.dlon, 0, nx - 1)
+
+        y0 = np.minimum(y.astype(np.int64), ny - 2)
+        x0 = np.minimum(x.astype(np.int64), nx - 2)
+        fy = y - y0
+        fx = x - x0
+
+        indices = np.stack(
+            [
+                y0 * nx + x0,
+                y0 * nx + x0 + 1,
+                (y0 + 1) * nx + x0,
+                (y0 + 1) * nx + x0 + 1,
+            ],
+            axis=-1,
+        )
+        weights = np.stack(
+            [(1 - fy) * (1 - fx), (1 - fy) * fx, fy * (1 - fx), fy * fx], axis=-1
+        )
+
+        return indices, weights
+
+    def cells(self, lat, lon) -> np.ndarray:
+        """Find the grid cell the locations fall in, as the flat index of the nearest
+        grid point.
+
+        Args:
+            lat: The latitude of the locations, a float or an array of shape N.
+            lon: The longitude of the locations, a float or an array of shape N.
+
+        Returns:
+            np.ndarray: The flat indices of the cells.
+        """
+
+        indices, weights = self.weights(lat, lon)
+        nearest = np.argmax(weights, axis=-1)
+
+        return np.take_along_axis(indices, nearest[..., None], axis=-1)[..., 0]
+
+
+def solar_zenith(lats: np.ndarray, lons: np.ndarray, times: np.ndarray) -> np.ndarray:
+    """Compute the solar zenith angle for every combination of location and time in a
+    single vectorized pass, using the analytical solar position of Spencer (1971).
+
+    Args:
+        lats (np.ndarray): The latitude of the locations, of shape N.
+        lons (np.ndarray): The longitude of the locations, of shape N.
+        times (np.ndarray): The times in UTC, as datetime64 of shape T.
+
+    Returns:
+        np.ndarray: The zenith in degrees, of shape NxT.
+    """
+
+    dayofyear = pd.DatetimeIndex(times).dayofyear.to_numpy()
+    hours = (times - times.astype("datetime64[D]")) / np.timedelta64(1, "h")
+
+    declination = solarposition.declination_spencer71(dayofyear)
+    equation_of_time = solarposition.equation_of_time_spencer71(dayofyear)
+
+    # The hour angle in degrees, the equation of time is in minutes
+    hour_angle = (
+        15 * (hours[None, :] - 12)
+        + np.asarray(lons)[:, None]
+        + equation_of_time[None, :] / 4
+    )
+
+    zenith = solarposition.solar_zenith_analytical(
+        np.radians(np.asarray(lats))[:, None],
+        np.radians(hour_angle),
+        declination[None, :],
+    )
+
+    return np.degrees(zenith)
+
+
+@dataclass(frozen=True)
+class Forecast:
+    """Parsed weather forecast of a single HARMONIE run over the full grid. Instances are
+    never modified, so a new run can be swapped in while requests are reading the
+    previous one.
+
+    Args:
+        run (str): The name of the KNMI file the forecast was built from.
+        times (np.ndarray): The valid time of every step, as datetime64.
+        cube (np.ndarray): The fields of every step, as a float32 array of shape
+            VxTxNjxNi in the order of VARIABLES. Loaded forecasts are memory-mapped.
+        grid (GridIndex): The index over the grid of the fields.
+    """
+
+    run: str
+    times: np.ndarray
+    cube: np.ndarray
+    grid: GridIndex
+    # Zenith angles of every timestamp per grid cell, filled in as cells are requested
+    zeniths: dict = field(default_factory=dict, init=False, repr=False, compare=False)
+
+    @classmethod
+    def load(cls, directory: str) -> "Forecast":
+        """Map a forecast saved with save. The cube is memory-mapped read-only, so every
+        process that loads the same run shares its pages instead of holding a copy.
+
+        Args:
+            directory (str): The folder of the run.
+
+        Returns:
+            Forecast: The forecast.
+        """
+
+        with open(os.path.join(directory, "run.txt")) as f:
+            run = f.read().strip()
+
+        return cls(
+            run=run,
+            times=np.load(os.path.join(directory, "times.npy")),
+            cube=np.load(os.path.join(directory, "cube.npy"), mmap_mode="r"),
+            grid=GridIndex(
+                np.load(os.path.join(directory, "lats.npy")),
+                np.load(os.path.join(directory, "lons.npy")),
+            ),
+        )
+
+    def save(self, directory: str):
+        """Save the forecast as plain arrays in a folder, which can be mapped with load.
+        The folder is written under a temporary name ending in ".tmp-<random>" and
+        renamed when it is complete.
+
+        Args:
+            directory (str): The folder of the run, which must not exist yet.
+        """
+
+        # A unique name, so a folder left behind by a crashed save is never reused
+        tmp_directory = tempfile.mkdtemp(
+            prefix=f"{os.path.basename(directory)}.tmp-",
+            dir=os.path.dirname(directory) or ".",
+        )
+
+        with open(os.path.join(tmp_directory, "run.txt"), "w") as f:
+            f.write(self.run)
+
+        np.save(os.path.join(tmp_directory, "times.npy"), self.times)
+        np.save(os.path.join(tmp_directory, "cube.npy"), self.cube)
+        np.save(os.path.join(tmp_directory, "lats.npy"), self.grid.lats)
+        np.save(os.path.join(tmp_directory, "lons.npy"), self.grid.lons)
+
+        os.rename(tmp_directory, directory)
+
+    def points(self, lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+        """Interpolate the fields at many locations at once.
+
+        Args:
+            lats (np.ndarray): The latitude of the locations, of shape N.
+            lons (np.ndarray): The longitude of the locations, of shape N.
+
+        Returns:
+            np.ndarray: The series of every variable, of shape VxNxT.
+        """
+
+        indices, weights = self.grid.weights(lats, lons)
+        flat = self.cube.reshape(*self.cube.shape[:2], -1)
+
+        return np.einsum("vtnk,nk->vnt", flat[:, :, indices], weights)
+
+    def point(self, lat: float, lon: float) -> np.ndarray:
+        """Interpolate the fields at a location.
+
+        Args:
+            lat (float): The latitude of the location.
+            lon (float): The longitude of the location.
+
+        Returns:
+            np.ndarray: The series of every variable, of shape VxT.
+        """
+
+        return self.points(np.array([lat]), np.array([lon]))[:, 0]
+
+    def zenith(self, lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+        """The solar zenith at every timestamp of the forecast. The zenith is computed at
+        the grid cell of the locations, so locations in the same cell share the result.
+
+        Args:
+            lats (np.ndarray): The latitude of the locations, of shape N.
+            lons (np.ndarray): The longitude of the locations, of shape N.
+
+        Returns:
+            np.ndarray: The zenith in degrees, of shape NxT.
+        """
+
+        cells = self.grid.cells(lats, lons)
+        missing = np.unique([cell for cell in cells if cell not in self.zeniths])
+
+        if len(missing):
+            zenith = solar_zenith(
+                self.grid.lats.ravel()[missing],
+                self.grid.lons.ravel()[missing],
+                self.times,
+            )
+            self.zeniths.update(zip(missing.tolist(), zenith))
+
+        return np.stack([self.zeniths[cell] for cell in cells.tolist()])
+
+    def dynamic_features_batch(self, lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+        """The dynamic features of the energy prediction model at many locations, grouped
+        per day. Every stage runs on the full NxT arrays at once.
+
+        Args:
+            lats (np.ndarray): The latitude of the locations, of shape N.
+            lons (np.ndarray): The longitude of the locations, of shape N.
+
+        Returns:
+            np.ndarray: The features as a float32 array of shape NxDx24x5.
+        """
+
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+
+        temperature, wind_speed, global_radiation = self.points(lats, lons)
+
+        # Hourly irradiance from the accumulated global radiation
+        ghi = np.diff(global_radiation, axis=1, prepend=np.nan) / 3600
+
+        # Method 'Erbs' to go from GHI to DNI and DHI
+        dayofyear = pd.DatetimeIndex(self.times).dayofyear.to_numpy()
+        irradiance_data = irradiance.erbs(
+            ghi,
+            self.zenith(lats, lons),
+            np.broadcast_to(dayofyear, ghi.shape),
+        )
+
+        features = np.stack(
+            [
+                temperature,
+                wind_speed,
+                irradiance_data["dni"],
+                irradiance_data["dhi"],
+                global_radiation,
+            ],
+            axis=-1,
+        )
+
+        # The last step is only needed for the difference of the radiation
+        features = np.nan_to_num(features[:, :-1]).astype(np.float32)
+
+        days = features.shape[1] // 24
+
+        return features[:, : days * 24].reshape(
+            len(lats), days, 24, len(DYNAMIC_FEATURES)
+        )
+
+    def dynamic_features(self, lat: float, lon: float) -> np.ndarray:
+        """The dynamic features of the energy prediction model at a location, grouped
+        per day.
+
+        Args:
+            lat (float): The latitude of the location.
+            lon (float): The longitude of the location.
+
+        Returns:
+            np.ndarray: The features as a float32 array of shape Dx24x5.
+        """
+
+        return self.dynamic_features_batch(np.array([lat]), np.array([lon]))[0]
@@ -0,0 +1,144 @@
+import numpy as np
+
+# Size in pixels of the single tile that covers the world at zoom level 0
+TILE_SIZE = 256
+# Circumference of the earth at the equator in meters, as used by Web Mercator
+EARTH_CIRCUMFERENCE = 2 * np.pi * 6378137
+
+
+def world_size(zoom: int) -> int:
+    """The size in pixels of the whole world at the zoom level.
+
+    Args:
+        zoom (int): The zoom level.
+
+    Returns:
+        int: The width and height of the world in pixels.
+    """
+
+    return TILE_SIZE * 2**zoom
+
+
+def lat_lng_to_pixels(lat, lng, zoom: int) -> tuple:
+    """Project locations to global Web Mercator pixel coordinates, the coordinates of the
+    pixels of Google Maps with the origin at the top left of the world.
+
+    Args:
+        lat: The latitude, a float or an array.
+        lng: The longitude, a float or an array.
+        zoom (int): The zoom level.
+
+    Returns:
+        tuple: The x and y pixel coordinates.
+    """
+
+    size = world_size(zoom)
+    sin_lat = np.sin(np.radians(lat))
+
+    x = (np.asarray(lng) / 360 + 0.5) * size
+    y = (0.5 - np.log((1 + sin_lat) / (1 - sin_lat)) / (4 * np.pi)) * size
+
+    return x, y
+
+
+def pixels_to_lat_lng(x, y, zoom: int) -> tuple:
+    """Convert global Web Mercator pixel coordinates back to locations.
+
+    Args:
+        x: The x pixel coordinate, a float or an array.
+        y: The y pixel coordinate, a float or an array.
+        zoom (int): The zoom level.
+
+    Returns:
+        tuple: The latitude and longitude.
+    """
+
+    size = world_size(zoom)
+
+    lng = (np.asarray(x) / size - 0.5) * 360
+    lat = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * np.asarray(y) / size))))
+
+    return lat, lng
+
+
+def image_origin(lat: float, lng: float, zoom: int, size: int) -> tuple:
+    """The global pixel coordinates of the top left corner of a static map image.
+
+    Args:
+        lat (float): The latitude of the center of the image.
+        lng (float): The longitude of the center of the image.
+        zoom (int): The zoom level of the image.
+        size (int): The width and height of the image in pixels.
+
+    Returns:
+        tuple: The x and y pixel coordinates.
+    """
+
+    x, y = lat_lng_to_pixels(lat, lng, zoom)
+
+    return float(x) - size / 2, float(y) - size / 2
+
+
+def meters_per_pixel(lat, zoom: int):
+    """The size of a pixel on the ground, which shrinks with the cosine of the latitude.
+
+    Args:
+        lat: The latitude, a float or an array.
+        zoom (int): The zoom level.
+
+    Returns:
+        The width and height of a pixel in meters.
+    """
+
+    return EARTH_CIRCUMFERENCE * np.cos(np.radians(lat)) / world_size(zoom)
+
+
+def project_polygons(
+    origin: tuple, polygons: list, centers: list, zoom: int
+) -> tuple:
+    """Convert polygons and their centers from image pixels to locations, and compute
+    the area of the polygons. The vertices of all the polygons are projected together.
+
+    Args:
+        origin (tuple): The global pixel coordinates of the top left corner of the image.
+        polygons (list): The polygons, arrays of Kx2 or Kx1x2 pixel coordinates.
+        centers (list): The center of every polygon in pixel coordinates.
+        zoom (int): The zoom level of the image.
+
+    Returns:
+        tuple: The vertices of every polygon as a Kx2 array of latitude and longitude,
+            the centers as an Nx2 array of latitude and longitude and the areas of the
+            polygons in square meters.
+    """
+
+    if not polygons:
+        return [], np.empty((0, 2)), np.empty(0)
+
+    left, top = origin
+
+    points = [
+        np.asarray(polygon, dtype=np.float64).reshape(-1, 2) for polygon in polygons
+    ]
+    lengths = np.array([len(polygon) for polygon in points])
+    offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    points = np.concatenate(points)
+
+    # Shoelace formula on the pixels, every vertex is paired with the next vertex of its
+    # own polygon
+    following = np.arange(len(points)) + 1
+    following[offsets + lengths - 1] = offsets
+    cross = points[:, 0] * points[following, 1] - points[following, 0] * points[:, 1]
+    pixel_areas = np.abs(np.add.reduceat(cross, offsets)) / 2
+
+    lats, lngs = pixels_to_lat_lng(left + points[:, 0], top + points[:, 1], zoom)
+    vertices = np.split(np.column_stack([lats, lngs]), offsets[1:])
+
+    centers = np.asarray(centers, dtype=np.float64).reshape(-1, 2)
+    center_lats, center_lngs = pixels_to_lat_lng(
+        left + centers[:, 0], top + centers[:, 1], zoom
+    )
+
+    # Panels are small enough for the scale at their center to hold for all of them
+    areas = pixel_areas * meters_per_pixel(center_lats, zoom) ** 2
+
+    return vertices, np.column_stack([center_lats, center_lngs]), areas
@@ -1,149 +1,141 @@
-import googlemaps.client
-import requests
 import numpy as np
-import googlemaps
 import logging
-
-from PIL import Image
+import asyncio
 
 from dotenv import load_dotenv
 import os
 
+from server import http_client
+from server.tile_cache import TileCache, tile_key
+from server.roof_cache import RoofCache, MISSING, location_key
+from server.singleflight import SingleFlight
+
 ZOOM = 20
 IMAGE_SIZE = 640
-gmaps: googlemaps.client.Client = None
-
-
-def load_google_maps_api():
-    global gmaps
-
-    load_dotenv()
-    api_key = os.getenv("GOOGLE_MAPS_API_KEY")
+STATIC_MAP_URL = "https://maps.googleapis.com/maps/api/staticmap"
 
-    gmaps = googlemaps.Client(key=api_key)
+# Location and limits of the satellite tile cache
+TILE_CACHE_DIR = os.getenv("TILE_CACHE_DIR", "cache")
+TILE_CACHE_MAX_BYTES = int(os.getenv("TILE_CACHE_MAX_BYTES", 1024**3))
+TILE_CACHE_MEMORY_TILES = int(os.getenv("TILE_CACHE_MEMORY_TILES", 128))
 
+# Location, lifetime and location precision of the roof information cache
+ROOF_CACHE_PATH = os.getenv("ROOF_CACHE_PATH", "cache/roofs.sqlite")
+ROOF_CACHE_TTL = float(os.getenv("ROOF_CACHE_TTL", 30 * 24 * 3600))
+ROOF_CACHE_NEGATIVE_TTL = float(os.getenv("ROOF_CACHE_NEGATIVE_TTL", 24 * 3600))
+ROOF_CACHE_PRECISION = int(os.getenv("ROOF_CACHE_PRECISION", 5))
 
-def unload_google_maps_api():
-    global gmaps
-    gmaps = None
+api_key: str = None
+tile_cache: TileCache = None
+roof_cache: RoofCache = None
 
+# Concurrent requests for the same tile or roof share a single upstream call
+tile_flights = SingleFlight("tiles")
+roof_flights = SingleFlight("roofs")
 
-def check_cache(center: str):
-    """This function will check if the corresponding image is already in the cache.
-    If it is, it will return the image. If it is not, it will return None.
 
-    Args:
-        center (str): The center of the image.
+def load_google_maps_api():
+    global api_key, tile_cache, roof_cache
 
-    Returns:
-        Image: The image if it is in the cache, None otherwise.
-    """
+    load_dotenv()
+    api_key = os.getenv("GOOGLE_MAPS_API_KEY")
 
-    # Currently the "cache" is just gonna be a folder in the same directory as the script
+    tile_cache = TileCache(
+        TILE_CACHE_DIR,
+        max_bytes=TILE_CACHE_MAX_BYTES,
+        memory_tiles=TILE_CACHE_MEMORY_TILES,
+    )
+    roof_cache = RoofCache(
+        ROOF_CACHE_PATH,
+        ttl=ROOF_CACHE_TTL,
+        negative_ttl=ROOF_CACHE_NEGATIVE_TTL,
+    )
 
-    # Check if the cache folder exists
-    if not os.path.exists("cache"):
-        os.makedirs("cache")
 
-    # Check if the image is already in the cache
-    if os.path.exists(f"cache/{center}.png"):
-        return Image.open(f"cache/{center}.png").convert("RGB")
-    else:
-        return None
+def unload_google_maps_api():
+    global api_key, tile_cache, roof_cache
+    roof_cache.close()
+    api_key = None
+    tile_cache = None
+    roof_cache = None
 
 
-def read_image(image, center: str) -> Image:
-    """Read the image by savinng it as a file and then deleting
-    that file afterwards
+async def fetch_google_maps_static_image(center: str) -> np.ndarray:
+    """Fetch the static image from Google Maps, or from the tile cache when it was
+    fetched before.
 
     Args:
-        image: The image to be saved.
         center (str): The center of the image.
 
     Returns:
-        Image: The image.
+        np.ndarray: The image as a HxWx3 uint8 array, which must not be modified.
     """
 
-    with open(f"cache/{center}.png", "wb") as f:
-        for chunk in image:
-            f.write(chunk)
-
-    # Read the image from the cache
-    img = Image.open(f"cache/{center}.png").convert("RGB")
+    key = tile_key(center, ZOOM, IMAGE_SIZE)
 
-    # Remove the image from the cache
-    os.remove(f"cache/{center}.png")
+    # Hot tiles are served from memory, the disk tier is read in a thread
+    image = tile_cache.get_memory(key)
+    if image is None:
+        image = await asyncio.to_thread(tile_cache.get, key)
 
-    return img
+    if image is not None:
+        return image
 
+    return await tile_flights.do(key, _download_static_image, key, center)
 
-def fetch_google_maps_static_image(center: str) -> Image:
-    """Fetch the static image from Google Maps.
 
-    Args:
-        center (str): The center of the image.
+async def _download_static_image(key: str, center: str) -> np.ndarray:
+    maptype = "satellite"
 
-    Returns:
-        Image: The image.
-    """
+    params = {
+        "center": center,
+        "zoom": ZOOM,
+        "size": f"{IMAGE_SIZE}x{IMAGE_SIZE}",
+        "maptype": maptype,
+        "key": api_key,
+    }
 
-    global ZOOM, IMAGE_SIZE, gmaps
-    maptype = "satellite"
+    res = await http_client.request("GET", STATIC_MAP_URL, params=params)
+    res.raise_for_status()
 
-    image = check_cache(center)
+    return await asyncio.to_thread(tile_cache.put, key, res.content)
 
-    if image is not None:
-        return image
 
-    image = gmaps.static_map(
-        center=center,
-        zoom=ZOOM,
-        size=IMAGE_SIZE,
-        maptype=maptype,
-    )
+def tile_cache_metrics() -> dict:
+    return tile_cache.stats()
 
-    image = read_image(image, center)
 
-    return image
+def roof_cache_metrics() -> dict:
+    return roof_cache.stats()
 
 
-def pixels_to_lat_lng(center: str, pixel: tuple) -> tuple:
-    """Convert the pixel to latitude and longitude.
+async def fetch_roof_information(center: str) -> dict:
+    """Fetch the roof information from the building with the given center
+    from the google maps Solar API, or from the roof cache when the location
+    was looked up before.
 
     Args:
-        center (str): The center of the image.
-        pixel (tuple): The pixel to be converted.
+        center (str): The center of the solar panel which belongs to the building
 
     Returns:
-        tuple: The latitude and longitude.
+        dict: The roof slope and azimuth in a dictionary
     """
 
-    global ZOOM, IMAGE_SIZE
-
-    x, y = pixel
     lat, lng = map(float, center.split(","))
 
-    parallelMultiplier = np.cos(lat * np.pi / 180)
-    degreesPerPixelX = 360 / np.power(2, ZOOM + 8)
-    degreesPerPixelY = 360 / np.power(2, ZOOM + 8) * parallelMultiplier
-    pointLat = lat - degreesPerPixelY * (y - IMAGE_SIZE / 2)
-    pointLng = lng + degreesPerPixelX * (x - IMAGE_SIZE / 2)
+    key = location_key(lat, lng, ROOF_CACHE_PRECISION)
+    roof = roof_cache.get(key)
 
-    return pointLat, pointLng
+    if roof is MISSING:
+        return None
 
+    if roof is not None:
+        return roof
 
-def fetch_roof_information(center: str) -> dict:
-    """Fetch the roof information from the building with the given center
-    from the google maps Solar API
+    return await roof_flights.do(key, _fetch_roof, key, center)
 
-    Args:
-        center (str): The center of the solar panel which belongs to the building
 
-    Returns:
-        dict: The roof slope and azimuth in a dictionary
-    """
-
-    api_key = gmaps.key
+async def _fetch_roof(key: str, center: str) -> dict:
     url = "https://solar.googleapis.com/v1/buildingInsights:findClosest"
 
     required_quality = "LOW"
@@ -158,7 +150,13 @@ def fetch_roof_information(center: str) -> dict:
 
     logging.info(f"Fetching roof information for {center}")
 
-    res = requests.get(url, params=params)
+    res = await http_client.request("GET", url, params=params)
+
+    # There is no building at this location, which is worth remembering
+    if res.status_code == 404:
+        logging.info(f"No roof information for {center}")
+        await asyncio.to_thread(roof_cache.put_missing, key)
+        return None
 
     if res.status_code != 200:
         logging.error(f"Error fetching roof information: {res.text}")
@@ -166,11 +164,22 @@ def fetch_roof_information(center: str) -> dict:
 
     data = res.json()
 
-    # roofSegmentStats is a list and we only want the first value
-    roofSegmentStats = data["solarPotential"]["roofSegmentStats"][0]
+    try:
+        # roofSegmentStats is a list and we only want the first value
+        roofSegmentStats = data["solarPotential"]["roofSegmentStats"][0]
+    except (KeyError, IndexError):
+        logging.info(f"No roof segments for {center}")
+        await asyncio.to_thread(roof_cache.put_missing, key)
+        return None
 
     # From data we can extract the azimuth and the tilt of the roof
-    return {
+    roof = {
         "azimuth": roofSegmentStats["azimuthDegrees"],
         "tilt": roofSegmentStats["pitchDegrees"],
     }
+
+    # Panels on the same building share the entry of the building
+    building_id = data.get("name", key)
+    await asyncio.to_thread(roof_cache.put, key, building_id, roof)
+
+    return roof
@@ -0,0 +1,153 @@
+import asyncio
+import logging
+import os
+import random
+from collections import defaultdict
+from contextlib import asynccontextmanager
+
+import httpx
+
+from server import executors
+
+logger = logging.getLogger(__name__)
+
+# Timeout in seconds for connecting to and reading from upstream services
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", 30))
+# Size of the connection pool shared by all upstream services
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", 64))
+# Maximum number of concurrent requests to a single host
+HTTP_MAX_CONNECTIONS_PER_HOST = int(os.getenv("HTTP_MAX_CONNECTIONS_PER_HOST", 16))
+# Number of times a failed request is retried, and the base of the exponential backoff
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", 3))
+HTTP_BACKOFF = float(os.getenv("HTTP_BACKOFF", 0.5))
+
+# Status codes that indicate a transient upstream failure
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+client: httpx.AsyncClient = None
+host_limits: dict = None
+
+
+def load_http_client():
+    """Create the shared HTTP client. Connections are kept alive and reused by all the
+    requests to Google and KNMI, so we only pay for the TLS handshake once per connection.
+    """
+
+    global client, host_limits
+
+    # HTTP/2 is only available when the h2 package is installed
+    try:
+        import h2  # noqa: F401
+
+        http2 = True
+    except ImportError:
+        http2 = False
+
+    client = httpx.AsyncClient(
+        http2=http2,
+        timeout=httpx.Timeout(HTTP_TIMEOUT),
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_CONNECTIONS,
+        ),
+        follow_redirects=True,
+    )
+    host_limits = defaultdict(
+        lambda: asyncio.Semaphore(HTTP_MAX_CONNECTIONS_PER_HOST)
+    )
+
+
+async def unload_http_client():
+    global client, host_limits
+
+    await client.aclose()
+    client = None
+    host_limits = None
+
+
+@asynccontextmanager
+async def _slot(url: str):
+    # Both the per host limit and the global upstream limit have to be respected
+    async with host_limits[httpx.URL(url).host], executors.io_limiter.slot():
+        yield
+
+
+async def _backoff(attempt: int):
+    await asyncio.sleep(HTTP_BACKOFF * 2**attempt * (1 + random.random()))
+
+
+async def request(method: str, url: str, **kwargs) -> httpx.Response:
+    """Send a request with the shared client, retrying with exponential backoff on
+    connection errors and transient status codes.
+
+    Args:
+        method (str): The HTTP method.
+        url (str): The url to send the request to.
+        **kwargs: Passed on to httpx.AsyncClient.request.
+
+    Returns:
+        httpx.Response: The response of the last attempt.
+    """
+
+    for attempt in range(HTTP_RETRIES + 1):
+        try:
+            async with _slot(url):
+                response = await client.request(method, url, **kwargs)
+        except httpx.TransportError as e:
+            if attempt == HTTP_RETRIES:
+                raise
+
+            logger.warning(f"Request to {url} failed ({e!r}), retrying")
+        else:
+            if response.status_code not in RETRY_STATUS_CODES or attempt == HTTP_RETRIES:
+                return response
+
+            logger.warning(
+                f"Request to {url} returned {response.status_code}, retrying"
+            )
+
+        await _backoff(attempt)
+
+
+@asynccontextmanager
+async def stream(method: str, url: str, **kwargs):
+    """Open a streaming request with the shared client. Opening the request is retried
+    like in request, but a failure while reading the body is raised to the caller.
+
+    Args:
+        method (str): The HTTP method.
+        url (str): The url to send the request to.
+        **kwargs: Passed on to httpx.AsyncClient.build_request.
+
+    Yields:
+        httpx.Response: The response, of which the body has not been read yet.
+    """
+
+    for attempt in range(HTTP_RETRIES + 1):
+        async with _slot(url):
+            try:
+                response = await client.send(
+                    client.build_request(method, url, **kwargs), stream=True
+                )
+            except httpx.TransportError as e:
+                if attempt == HTTP_RETRIES:
+                    raise
+
+                logger.warning(f"Request to {url} failed ({e!r}), retrying")
+            else:
+                try:
+                    if (
+                        response.status_code not in RETRY_STATUS_CODES
+                        or attempt == HTTP_RETRIES
+                    ):
+                        response.raise_for_status()
+                        yield response
+                        return
+
+                    logger.warning(
+                        f"Request to {url} returned {response.status_code}, retrying"
+                    )
+                finally:
+                    await response.aclose()
+
+        await _backoff(attempt)
@@ -1,83 +1,293 @@
-from typing import Tuple, List
+from typing import Tuple
+import os
+import asyncio
+import logging
+import threading
 
-from torch import float32
 import torchvision.transforms.v2 as transforms
 
-import pandas as pd
 import numpy as np
 import cv2
 from PIL import Image
 
 import torch
-import pickle
 
 # from losses import LossJaccard
 
-# from models.architectures import DeepLabModel
-from models.base import BaseModel
+from server.executors import run_cpu
+from server.model_artifacts import load_segmentation_artifact
 
-from server.energy_prediction_model import EnergyPredictionModel
+logger = logging.getLogger(__name__)
 
 segmentation_model = None
-energy_prediction_model = None
+device = None
+preprocessor = None
+segmentation_batcher = None
+
+# Maximum number of images stacked into a single forward pass of the segmentation model
+SEGMENTATION_BATCH_SIZE = int(os.getenv("SEGMENTATION_BATCH_SIZE", 8))
+# Maximum time the first image of a batch waits for other images to join it
+SEGMENTATION_MAX_WAIT_MS = float(os.getenv("SEGMENTATION_MAX_WAIT_MS", 5))
+# "torch" serves the FP32 model, "int8" the model of pv_segmentation/quantize.py
+# and "onnx" the model of "python -m server.export_models segmentation-onnx"
+SEGMENTATION_BACKEND = os.getenv("SEGMENTATION_BACKEND", "torch")
+# Weights written by "python -m server.export_models segmentation-artifact", the
+# Lightning checkpoint is only loaded when they are missing
+SEGMENTATION_MODEL_PATH = os.getenv(
+    "SEGMENTATION_MODEL_PATH", "segmentation_model.safetensors"
+)
+# Map the weights of the artifact read-only on the cpu, so that all the workers of the
+# server share a single copy of them in the page cache
+SEGMENTATION_MMAP_WEIGHTS = os.getenv("SEGMENTATION_MMAP_WEIGHTS", "0") == "1"
+SEGMENTATION_INT8_PATH = os.getenv(
+    "SEGMENTATION_INT8_PATH", "segmentation_model_int8.pt"
+)
+SEGMENTATION_ONNX_PATH = os.getenv("SEGMENTATION_ONNX_PATH", "segmentation_model.onnx")
+# Threads of the ONNX Runtime session, 0 lets ONNX Runtime decide
+SEGMENTATION_INTRA_OP_THREADS = int(os.getenv("SEGMENTATION_INTRA_OP_THREADS", 0))
+SEGMENTATION_INTER_OP_THREADS = int(os.getenv("SEGMENTATION_INTER_OP_THREADS", 0))
+# Graph optimisation level of ONNX Runtime: disable, basic, extended or all
+SEGMENTATION_GRAPH_OPTIMIZATION = os.getenv("SEGMENTATION_GRAPH_OPTIMIZATION", "all")
+
+# Side of the square images the segmentation model takes
+SEGMENTATION_INPUT_SIZE = 640
+# ImageNet statistics the encoder of the segmentation model was trained with
+IMAGENET_MEAN = [0.485, 0.456, 0.406]
+IMAGENET_STD = [0.229, 0.224, 0.225]
+
+
+class Preprocessor:
+    """Turns RGB images into the normalized input of the segmentation model. The resize
+    transform and the normalisation constants are built once, and every thread normalizes
+    its batches in place into its own preallocated input buffer, so preprocessing a batch
+    does not allocate a new input tensor.
+
+    Args:
+        batch_size (int): The number of images the input buffers are sized for.
+    """
+
+    def __init__(self, batch_size: int):
+        self.batch_size = batch_size
+        self.resize = transforms.Resize(
+            (SEGMENTATION_INPUT_SIZE, SEGMENTATION_INPUT_SIZE),
+            interpolation=transforms.InterpolationMode.NEAREST,
+        )
+
+        # The scaling of the uint8 pixels to [0, 1] is folded into the statistics
+        self.mean = torch.tensor(IMAGENET_MEAN).view(3, 1, 1) * 255
+        self.scale = 1 / (torch.tensor(IMAGENET_STD).view(3, 1, 1) * 255)
+
+        self.buffers = threading.local()
+
+    def fit(self, image: np.ndarray) -> np.ndarray:
+        """Resize an image to the input size of the model, unless it has that size
+        already. The masks of the model have the size of the resized image, so it is the
+        image that has to be post-processed.
+
+        Args:
+            image (np.ndarray): The RGB image, as HxWx3 uint8.
+
+        Returns:
+            np.ndarray: The image of shape 640x640x3, as uint8.
+        """
+
+        if image.shape[:2] == (SEGMENTATION_INPUT_SIZE, SEGMENTATION_INPUT_SIZE):
+            return image
+
+        resized = self.resize(torch.from_numpy(image).permute(2, 0, 1))
+
+        return np.ascontiguousarray(resized.permute(1, 2, 0).numpy())
+
+    def to_tensor(self, image: np.ndarray) -> torch.Tensor:
+        """View an image as a 3xHxW uint8 tensor without copying it. Only images that
+        are not 640x640 yet are resized, which does copy them.
+
+        Args:
+            image (np.ndarray): The RGB image, as HxWx3 uint8.
+
+        Returns:
+            torch.Tensor: The image of shape 3x640x640, as uint8.
+        """
+
+        return torch.from_numpy(self.fit(image)).permute(2, 0, 1)
+
+    def buffer(self, batch_size: int) -> torch.Tensor:
+        """The input buffer of the calling thread, grown when a batch does not fit."""
+
+        buffer = getattr(self.buffers, "images", None)
+
+        if buffer is None or len(buffer) < batch_size:
+            buffer = torch.empty(
+                max(batch_size, self.batch_size),
+                3,
+                SEGMENTATION_INPUT_SIZE,
+                SEGMENTATION_INPUT_SIZE,
+            )
+            self.buffers.images = buffer
+
+        return buffer[:batch_size]
+
+    def __call__(self, images: list) -> torch.Tensor:
+        """Normalize a batch of images into the input buffer of the calling thread. The
+        result is overwritten by the next batch of the same thread.
+
+        Args:
+            images (list): The RGB images, as HxWx3 uint8 arrays.
+
+        Returns:
+            torch.Tensor: The normalized images of shape Bx3x640x640.
+        """
+
+        batch = self.buffer(len(images))
+
+        # The copy converts the uint8 pixels to float32 and makes them contiguous
+        for slot, image in zip(batch, images):
+            slot.copy_(self.to_tensor(image))
+
+        return batch.sub_(self.mean).mul_(self.scale)
 
 
 def load_models():
-    """Load the machine learning models - Both these models need to be previously trained 
-    and saved in the same directory as this script.
+    """Load the segmentation model - It needs to be previously trained and saved in the
+    same directory as this script. The energy prediction model is loaded by
+    energy_inference.py.
     """
     
-    global segmentation_model, energy_prediction_model
-
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-
-    # Load the segmentation model
-    segmentation_model = BaseModel.load_from_checkpoint("segmentation_model.ckpt")
-    segmentation_model.eval()
-    segmentation_model.to(device)
-
-    # Load the dataset values
-    with open("dataset_values.pkl", "rb") as f:
-        dataset_values = pickle.load(f)
-
-    # Load the energy prediction model
-    # dynamic feature size =5, static feature_size =3. Hidden /fc_size is 8/128
-    energy_prediction_model = EnergyPredictionModel(
-        dynamic_feature_size=5,
-        static_feature_size=3,
-        hidden_size=8,
-        fc_size=128,
-        dataset_values=dataset_values,
-    )
-    energy_prediction_model.load_state_dict(torch.load("energy_prediction_model.pth"))
-    energy_prediction_model.eval()
-    energy_prediction_model.to(device)
+    global segmentation_model, device, preprocessor
+
+    preprocessor = Preprocessor(SEGMENTATION_BATCH_SIZE)
+
+    if SEGMENTATION_BACKEND == "int8":
+        # Quantized kernels only run on the cpu
+        device = torch.device("cpu")
+        segmentation_model = torch.jit.load(SEGMENTATION_INT8_PATH, map_location=device)
+    elif SEGMENTATION_BACKEND == "onnx":
+        # Only imported here, so the other backends do not need onnxruntime
+        from server.onnx_segmentation import OnnxSegmentationModel
+
+        device = torch.device("cpu")
+        onnx_model = OnnxSegmentationModel(
+            SEGMENTATION_ONNX_PATH,
+            intra_op_threads=SEGMENTATION_INTRA_OP_THREADS,
+            inter_op_threads=SEGMENTATION_INTER_OP_THREADS,
+            optimization_level=SEGMENTATION_GRAPH_OPTIMIZATION,
+        )
+
+        def run_onnx_model(images: torch.Tensor) -> torch.Tensor:
+            return torch.from_numpy(onnx_model(images.numpy()))
+
+        segmentation_model = run_onnx_model
+    else:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+        if os.path.exists(SEGMENTATION_MODEL_PATH):
+            segmentation_model = load_segmentation_artifact(
+                SEGMENTATION_MODEL_PATH, device, mmap=SEGMENTATION_MMAP_WEIGHTS
+            )
+        else:
+            # Only imported here, so serving the artifact does not need Lightning
+            from models.base import BaseModel
+
+            logger.warning(
+                f"{SEGMENTATION_MODEL_PATH} not found, loading the Lightning checkpoint"
+            )
+
+            # Load the segmentation model
+            segmentation_model = BaseModel.load_from_checkpoint("segmentation_model.ckpt")
+            segmentation_model.eval()
+            segmentation_model.to(device)
+
+    logger.info(f"Segmentation model loaded on the {SEGMENTATION_BACKEND} backend")
 
 
 def clean_up_models():
-    global segmentation_model, energy_prediction_model
+    global segmentation_model, preprocessor
 
     segmentation_model = None
-    energy_prediction_model = None
+    preprocessor = None
 
 
-def masks_to_polygons(mask: torch.Tensor) -> list:
-    """Convert the segmentation mask to polygons.
+def classify_panel(color: np.ndarray) -> str:
+    """Infer the panel type from the mean color of a panel.
+    Panel types can either be monocrytalline or polycrystalline.
 
     Args:
-        mask (torch.Tensor): The segmentation mask.
+        color (np.ndarray): The mean HSV color of the panel, in the uint8 ranges of
+            OpenCV: hue in 0-179, saturation and value in 0-255.
 
     Returns:
-        list: A list of polygons.
+        str: The inferred panel type.
+    """
+
+    black_threshold = 30  # Lower value for black
+    blue_threshold = 200  # Higher saturation for blue
+    # OpenCV stores the hue in degrees halved, so blue hues above 200 degrees are > 100
+    blue_hue_threshold = 100
+
+    # Check if the average color is black
+    if color[2] < black_threshold:
+        return "monocrystalline"
+    elif color[0] > blue_hue_threshold and color[1] > blue_threshold:
+        return "polycrystalline"
+    else:
+        return "monocrystalline"
+
+
+def postprocess_mask(image: np.ndarray, mask: torch.Tensor) -> Tuple[list, list, list]:
+    """Find the panels in the mask of an image in a single pass. Every connected component of the
+    mask is labelled once, and its polygon, center, area and mean color are derived from
+    that labelling, so the polygons, centers and types always line up.
+
+    Args:
+        image (np.ndarray): The RGB image the mask was predicted from, as HxWx3 uint8.
+        mask (torch.Tensor): The binary mask of the image.
+
+    Returns:
+        Tuple[list, list, list]: The polygons, centers and the pv types
     """
 
     mask = mask.cpu().numpy().astype(np.uint8)
 
-    # Put the mask in grey scale
-    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    count, labels, stats, centroids = cv2.connectedComponentsWithStats(
+        mask, connectivity=8
+    )
+
+    # Mean RGB color of every component, computed for all components at once
+    image = np.asarray(image)
+    flat_labels = labels.ravel()
+    sums = np.stack(
+        [
+            np.bincount(
+                flat_labels, weights=image[..., channel].ravel(), minlength=count
+            )
+            for channel in range(3)
+        ],
+        axis=1,
+    )
+    colors = sums / np.maximum(stats[:, cv2.CC_STAT_AREA], 1)[:, None]
+    colors = cv2.cvtColor(
+        colors.round().astype(np.uint8)[:, None, :], cv2.COLOR_RGB2HSV
+    )[:, 0]
 
     polygons = []
-    for contour in contours:
+    centers = []
+    panel_types = []
+
+    # Label 0 is the background
+    for label in range(1, count):
+        x, y, w, h, area = stats[label]
+
+        # A polygon inside the component can never be larger than the component itself
+        if area < 100:
+            continue
+
+        # Trace the outline of the component within its bounding box only
+        component = (labels[y : y + h, x : x + w] == label).astype(np.uint8)
+        contours, _ = cv2.findContours(
+            component, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE, offset=(x, y)
+        )
+        contour = max(contours, key=cv2.contourArea)
+
         epsilon = 0.01 * cv2.arcLength(contour, True)
         approx = cv2.approxPolyDP(contour, epsilon, True)
 
@@ -85,80 +295,46 @@ def masks_to_polygons(mask: torch.Tensor) -> list:
         if cv2.contourArea(approx) < 100:
             continue
 
-        # If the polygon has more than 3 points, then it is a valid polygon
-        if approx.shape[0] >= 3:
-            polygons.append(approx)
+        # If the polygon has less than 3 points, then it is not a valid polygon
+        if approx.shape[0] < 3:
+            continue
+
+        polygons.append(approx)
+        centers.append((int(centroids[label][0]), int(centroids[label][1])))
+        panel_types.append(classify_panel(colors[label]))
 
-    return polygons
+    return polygons, centers, panel_types
 
 
-def find_polygon_centers(polygons: list) -> list:
-    """Find the center of the polygons.
+def predict_masks(images: torch.Tensor) -> torch.Tensor:
+    """Run a single forward pass of the segmentation model over a batch of images.
 
     Args:
-        polygons (list): A list of polygons.
+        images (torch.Tensor): The normalized images of shape Bx3x640x640.
 
     Returns:
-        list: A list of centers.
+        torch.Tensor: The binary masks of shape Bx640x640, on the cpu.
     """
 
-    centers = []
-    for polygon in polygons:
-        moments = cv2.moments(polygon)
-        center = (
-            int(moments["m10"] / moments["m00"]),
-            int(moments["m01"] / moments["m00"]),
-        )
-        centers.append(center)
+    with torch.inference_mode():
+        probs = torch.sigmoid(segmentation_model(images.to(device)))
 
-    return centers
+    mask = (probs > 0.5).int()
 
+    return mask.squeeze(1).cpu()
 
-def infer_panel_types(image: Image.Image, mask: torch.Tensor) -> list:
-    """Infer the panel types based on the given image, mask and centers.
-    Panel types can either be monocrytalline or polycrystalline.
+
+def predict_image_masks(images: list) -> torch.Tensor:
+    """Preprocess a batch of images and run a single forward pass over it.
 
     Args:
-        image (Image): The image to infer the panel types from.
-        mask (torch.Tensor): The segmentation mask.
+        images (list): The RGB images, as HxWx3 uint8 arrays.
 
     Returns:
-        list: The inferred panel types.
+        torch.Tensor: The binary masks of shape Bx640x640, on the cpu.
     """
-    black_threshold = 30  # Lower value for black
-    blue_threshold = 200  # Higher saturation and value for blue
-
-    # Find the contours of the mask
-    mask = mask.cpu().numpy().astype(np.uint8)
-
-    # Convert the image to HSV color space
-    rgb_image = cv2.cvtColor(np.array(image), cv2.COLOR_GRAY2RGB)
-    hsv_image = cv2.cvtColor(np.array(rgb_image), cv2.COLOR_RGB2HSV)
-
-    # Find the countours
-    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-    # Create a mask with the same size as the image
-    panel_types = []
-    for contour in contours:
-        # Calculate the bounding rectangle for the contour
-        x, y, w, h = cv2.boundingRect(contour)
-
-        # Extract the region of interest (ROI) from the HSV image
-        roi = hsv_image[y : y + h, x : x + w]
-
-        # Calculate the average color of the ROI
-        avg_color = np.mean(roi, axis=(0, 1))
-
-        # Check if the average color is black
-        if avg_color[2] < black_threshold:
-            panel_types.append("monocrystalline")
-        elif avg_color[0] > blue_threshold and avg_color[1] > blue_threshold:
-            panel_types.append("polycrystalline")
-        else:
-            panel_types.append("monocrystalline")
 
-    return panel_types
+    return predict_masks(preprocessor(images))
 
 
 def segmentation_inference(image: Image.Image) -> Tuple[list, list, list]:
@@ -172,70 +348,173 @@ def segmentation_inference(image: Image.Image) -> Tuple[list, list, list]:
         Tuple[list, list, list]: The polygons, centers and the pv types
     """
 
-    transform = transforms.Compose(
-        [
-            transforms.ToImage(),
-            transforms.ToDtype(float32, scale=True),
-            transforms.Resize(
-                (640, 640), interpolation=transforms.InterpolationMode.NEAREST
-            ),
-            transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
-        ]
+    # The mask is predicted for the resized image, so that is the one post-processed
+    rgb_image = preprocessor.fit(np.array(image.convert("RGB")))
+    mask = predict_image_masks([rgb_image])[0]
+
+    return postprocess_mask(rgb_image, mask)
+
+
+class SegmentationBatcher:
+    """Micro-batching queue in front of the segmentation model. Images submitted by
+    concurrent requests are gathered until either max_batch_size images are pending or
+    the first pending image waited max_wait seconds, and are then run through a single
+    forward pass. Every caller receives its own mask through a future.
+
+    Args:
+        max_batch_size (int): Maximum number of images in a single forward pass.
+        max_wait (float): Maximum time in seconds to wait for a batch to fill up.
+    """
+
+    def __init__(self, max_batch_size: int, max_wait: float):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.task: asyncio.Task = None
+        # The batch that is being gathered or computed
+        self.batch = []
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self.task.cancel()
+
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+
+        # Fail the requests of the batch that was cut off, and those that never made it
+        # into a batch
+        pending = self.batch
+        self.batch = []
+
+        while not self.queue.empty():
+            pending.append(self.queue.get_nowait())
+
+        for _, future in pending:
+            if not future.done():
+                future.set_exception(RuntimeError("Segmentation batcher stopped"))
+
+    async def submit(self, image: np.ndarray) -> torch.Tensor:
+        """Queue a single image and wait for its mask.
+
+        Args:
+            image (np.ndarray): The RGB image, as HxWx3 uint8.
+
+        Returns:
+            torch.Tensor: The binary mask of the image.
+        """
+
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((image, future))
+
+        return await future
+
+    async def _next_batch(self) -> list:
+        loop = asyncio.get_running_loop()
+
+        # The batch is kept on the batcher, so stop can fail it when it is cancelled
+        self.batch = batch = [await self.queue.get()]
+        deadline = loop.time() + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            # Images that are queued already join without a round trip through the loop
+            while len(batch) < self.max_batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+
+            timeout = deadline - loop.time()
+            if len(batch) == self.max_batch_size or timeout <= 0:
+                break
+
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        # Callers that gave up waiting do not need to be computed
+        batch[:] = [(image, future) for image, future in batch if not future.done()]
+
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._next_batch()
+
+            if not batch:
+                continue
+
+            images = [image for image, _ in batch]
+
+            try:
+                # The images are normalized straight into the input buffer of the batch
+                masks = await run_cpu(predict_image_masks, images)
+            except Exception as e:
+                logger.exception("Segmentation batch failed")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+                self.batch = []
+                continue
+
+            for (_, future), mask in zip(batch, masks):
+                if not future.done():
+                    future.set_result(mask)
+
+            self.batch = []
+
+
+def start_segmentation_batcher():
+    global segmentation_batcher
+
+    segmentation_batcher = SegmentationBatcher(
+        max_batch_size=SEGMENTATION_BATCH_SIZE,
+        max_wait=SEGMENTATION_MAX_WAIT_MS / 1000,
     )
+    segmentation_batcher.start()
 
-    image = transform(image).unsqueeze(0)
 
-    probs = torch.sigmoid(segmentation_model(image))
-    mask = (probs > 0.5).int()
+async def stop_segmentation_batcher():
+    global segmentation_batcher
 
-    mask = mask.squeeze(0).squeeze(0)
+    await segmentation_batcher.stop()
+    segmentation_batcher = None
 
-    pvtypes = infer_panel_types(image, mask)
-    polygons = masks_to_polygons(mask)
-    centers = find_polygon_centers(polygons)
 
-    return polygons, centers, pvtypes
+async def batched_segmentation_mask(image: np.ndarray) -> torch.Tensor:
+    """Predict the mask of the given image through the micro-batching queue, so that the
+    forward pass is shared with other concurrent requests.
 
+    Args:
+        image (np.ndarray): The image to run the segmentation model on, as 640x640x3 uint8.
 
-def energy_prediction(df: pd.DataFrame) -> List[List[int]]:
-    """Predict the energy output for each day based on the given dataframe.
+    Returns:
+        torch.Tensor: The binary mask of the image, of shape 640x640.
+    """
+
+    return await segmentation_batcher.submit(image)
+
+
+async def batched_segmentation_inference(
+    image: np.ndarray,
+) -> Tuple[list, list, list]:
+    """Executes the segmentation model on the given image through the micro-batching
+    queue, so that the forward pass is shared with other concurrent requests. Images of
+    another size are resized to 640x640 first, the polygons are in its pixels.
 
     Args:
-        df (pd.DataFrame): The dataframe containing the desired features, each row is a day
+        image (np.ndarray): The image to run the segmentation model on, as HxWx3 uint8.
 
     Returns:
-        List[List[int]]: The predicted output for each hour for two days
+        Tuple[list, list, list]: The polygons, centers and the pv types
     """
 
-    # Column order
-    # sample dynamics = Bx24x5 and sample static is Bx3
-    dynamic_cols = [
-        "temperature_sequence",
-        "wind_speed_sequence",
-        "dni_sequence",
-        "dhi_sequence",
-        "global_irradiance_sequence",
-    ]
-    static_cols = ["tilt", "azimuth", "module_type"]
-
-    module_type_map = {
-        "monocrystalline": 0,
-        "polycrystalline": 1,
-    }
-
-    # Put the dynamic columns in a tensor
-    sample_dynamic = torch.tensor(df[dynamic_cols].values, dtype=torch.float32)
-    # size 2x24x5
-    sample_dynamic = sample_dynamic.view(-1, 24, 5)
-
-    # Put the static columns in a tensor
-    df["module_type"] = df["module_type"].map(module_type_map)
-    sample_static = torch.tensor(df[static_cols].values, dtype=torch.float32)
-    # size 2x3
-    sample_static = sample_static.view(-1, 3)[:2]
-
-    predictions: torch.Tensor = energy_prediction_model.predict(
-        sample_dynamic, sample_static
-    )
+    # The mask is predicted for the resized image, so that is the one post-processed
+    if image.shape[:2] != (SEGMENTATION_INPUT_SIZE, SEGMENTATION_INPUT_SIZE):
+        image = await run_cpu(preprocessor.fit, image)
+
+    mask = await batched_segmentation_mask(image)
 
-    return predictions.tolist()
+    return await run_cpu(postprocess_mask, image, mask)
@@ -1,35 +1,112 @@
 import os
+import asyncio
+from typing import List
+
+import numpy as np
 
 from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from pydantic import BaseModel
 
 from server.google_maps_api import (
     load_google_maps_api,
     unload_google_maps_api,
     fetch_google_maps_static_image,
-    pixels_to_lat_lng,
+    tile_cache_metrics,
+    roof_cache_metrics,
     fetch_roof_information,
+    ZOOM,
+    IMAGE_SIZE,
+)
+from server import geo
+
+from server.weather_data_api import (
+    load_forecast_store,
+    unload_forecast_store,
+    get_predicted_data,
 )
 
-from server.weather_data_api import get_predicted_data
+from server.executors import (
+    load_executors,
+    unload_executors,
+    run_cpu,
+    executor_metrics,
+)
+
+from server.http_client import load_http_client, unload_http_client
+from server.singleflight import singleflight_metrics
 
-from server.inference import (
-    segmentation_inference,
+from server.energy_inference import (
     energy_prediction,
-    load_models,
-    clean_up_models,
+    energy_prediction_batch,
+    static_features,
+    MODULE_TYPES,
+    load_energy_model,
+    unload_energy_model,
 )
 
+# Maximum number of centers in a single request of /segmentation/batch
+SEGMENTATION_BATCH_MAX_CENTERS = int(os.getenv("SEGMENTATION_BATCH_MAX_CENTERS", 32))
+# Maximum number of panels in a single request of /predictions/batch
+PREDICTION_BATCH_MAX_PANELS = int(os.getenv("PREDICTION_BATCH_MAX_PANELS", 100))
+
+# Workers that only serve predictions skip the segmentation model, and with it torch
+# when the energy model runs on the NumPy runtime
+SEGMENTATION_ENABLED = os.getenv("SEGMENTATION_ENABLED", "1") == "1"
+
+if SEGMENTATION_ENABLED:
+    from server.inference import (
+        batched_segmentation_inference,
+        load_models,
+        clean_up_models,
+        start_segmentation_batcher,
+        stop_segmentation_batcher,
+    )
+    from server.area_segmentation import (
+        TileGrid,
+        segment_area,
+        build_area_panels,
+        SEGMENTATION_AREA_MAX_TILES,
+        SEGMENTATION_AREA_OVERLAP,
+    )
+    from server.scans import (
+        load_scans,
+        unload_scans,
+        create_scan,
+        retry_scan,
+        get_scan,
+        SCAN_MAX_TILES,
+        SCAN_RESULTS_PAGE_SIZE,
+    )
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     load_google_maps_api()
-    load_models()
+    load_executors()
+    load_http_client()
+    load_energy_model()
+
+    if SEGMENTATION_ENABLED:
+        load_models()
+        start_segmentation_batcher()
+        load_scans()
+
+    await load_forecast_store()
 
     yield
 
-    clean_up_models()
+    await unload_forecast_store()
+
+    if SEGMENTATION_ENABLED:
+        await unload_scans()
+        await stop_segmentation_batcher()
+        clean_up_models()
+
+    unload_energy_model()
+    await unload_http_client()
+    unload_executors()
     unload_google_maps_api()
 
 
@@ -45,52 +122,345 @@ app.add_middleware(
 )
 
 
+class SegmentationBatchRequest(BaseModel):
+    centers: List[str]
+
+
+class AreaSegmentationRequest(BaseModel):
+    south: float
+    west: float
+    north: float
+    east: float
+
+
+class PredictionRequest(BaseModel):
+    center: str
+    type: str
+
+
+class PredictionBatchRequest(BaseModel):
+    panels: List[PredictionRequest]
+
+
+def build_panels(center: str, polygons: list, seg_centers: list, pvtypes: list) -> list:
+    """Convert the segmentation output of the image around center into panels with
+    real world coordinates.
+
+    Args:
+        center (str): The center of the image.
+        polygons (list): The polygons in pixel coordinates.
+        seg_centers (list): The centers of the polygons in pixel coordinates.
+        pvtypes (list): The pv type of each polygon.
+
+    Returns:
+        list: The panels with their polygon, center, area in m² and type.
+    """
+
+    lat, lng = map(float, center.split(","))
+
+    # Convert the centers and the polygon values into real world coordinates at once
+    origin = geo.image_origin(lat, lng, ZOOM, IMAGE_SIZE)
+
+    return build_area_panels(origin, polygons, seg_centers, pvtypes)
+
+
+def require_segmentation():
+    if not SEGMENTATION_ENABLED:
+        raise HTTPException(
+            status_code=503, detail="Segmentation is not served by this worker"
+        )
+
+
 @app.get("/segmentation")
 async def segment_solar_panel(center: str):
-    image = fetch_google_maps_static_image(center)
+    require_segmentation()
+
+    image = await fetch_google_maps_static_image(center)
+
+    # Run the machine learning model here, sharing the forward pass with concurrent requests
+    polygons, seg_centers, pvtypes = await batched_segmentation_inference(image)
+
+    return {
+        "panels": build_panels(center, polygons, seg_centers, pvtypes),
+    }
+
+
+@app.post("/segmentation/batch")
+async def segment_solar_panels(request: SegmentationBatchRequest):
+    require_segmentation()
 
-    # Run the machine learning model here
-    polygons, seg_centers, pvtypes = segmentation_inference(image)
+    # Duplicated centers only have to be fetched and segmented once
+    centers = list(dict.fromkeys(request.centers))
 
-    # Convert the centers and the polygon values into real world coordinates
-    seg_centers = [pixels_to_lat_lng(center, seg_center) for seg_center in seg_centers]
+    if len(centers) > SEGMENTATION_BATCH_MAX_CENTERS:
+        raise HTTPException(
+            status_code=422,
+            detail=f"The request has {len(centers)} centers, "
+            f"at most {SEGMENTATION_BATCH_MAX_CENTERS} are allowed",
+        )
 
-    polygons = [
-        [pixels_to_lat_lng(center, point[0]) for point in polygon]
-        for polygon in polygons
-    ]
+    # Fetch all the tiles concurrently
+    images = await asyncio.gather(
+        *(fetch_google_maps_static_image(center) for center in centers)
+    )
 
-    panels = [
-        {"polygon": polygon, "center": seg_center, "type": pvtype}
-        for polygon, seg_center, pvtype in zip(polygons, seg_centers, pvtypes)
-    ]
+    # The batcher stacks the tiles into a few large forward passes
+    results = await asyncio.gather(
+        *(batched_segmentation_inference(image) for image in images)
+    )
 
     return {
-        "panels": panels,
+        "results": {
+            center: {"panels": build_panels(center, *result)}
+            for center, result in zip(centers, results)
+        },
     }
 
 
+def validate_area(request: AreaSegmentationRequest):
+    require_segmentation()
+
+    if request.south >= request.north or request.west >= request.east:
+        raise HTTPException(status_code=422, detail="Invalid bounding box")
+
+
+@app.post("/segmentation/area")
+async def segment_solar_panels_in_area(request: AreaSegmentationRequest):
+    validate_area(request)
+
+    grid = TileGrid.from_bounds(
+        request.south,
+        request.west,
+        request.north,
+        request.east,
+        overlap=SEGMENTATION_AREA_OVERLAP,
+    )
+
+    if len(grid) > SEGMENTATION_AREA_MAX_TILES:
+        raise HTTPException(
+            status_code=422,
+            detail=f"The area needs {len(grid)} tiles, "
+            f"at most {SEGMENTATION_AREA_MAX_TILES} are allowed",
+        )
+
+    # The tiles are merged into a single mask, so every panel is returned once
+    return {
+        "panels": await segment_area(grid),
+        "tiles": len(grid),
+    }
+
+
+@app.post("/scans", status_code=202)
+async def create_panel_scan(request: AreaSegmentationRequest):
+    """Start a background scan of a large area, polled with GET /scans/{id}.
+
+    Unlike /segmentation/area, the tiles of a scan are not merged into a single mask.
+    Every panel is reported by the tile that owns its center, and a panel wider than the
+    overlap between tiles may be clipped at the edge of a tile or reported as two
+    fragments.
+    """
+
+    validate_area(request)
+
+    grid = TileGrid.from_bounds(
+        request.south,
+        request.west,
+        request.north,
+        request.east,
+        overlap=SEGMENTATION_AREA_OVERLAP,
+    )
+
+    if len(grid) > SCAN_MAX_TILES:
+        raise HTTPException(
+            status_code=422,
+            detail=f"The area needs {len(grid)} tiles, "
+            f"at most {SCAN_MAX_TILES} are allowed",
+        )
+
+    # The scan runs in the background, its progress is polled with GET /scans/{id}
+    job = await create_scan(request.model_dump(), SEGMENTATION_AREA_OVERLAP)
+
+    return job.status()
+
+
+@app.get("/scans/{id}")
+async def get_panel_scan(id: str, offset: int = 0, limit: int | None = None):
+    require_segmentation()
+
+    if limit is None:
+        limit = SCAN_RESULTS_PAGE_SIZE
+
+    if offset < 0 or not 0 < limit <= SCAN_RESULTS_PAGE_SIZE:
+        raise HTTPException(
+            status_code=422,
+            detail=f"The offset must not be negative and the limit between 1 and "
+            f"{SCAN_RESULTS_PAGE_SIZE}",
+        )
+
+    job = await get_scan(id)
+
+    if job is None:
+        raise HTTPException(status_code=404, detail="Scan not found")
+
+    status = job.status()
+
+    # The panels are only returned once every tile was processed, a page at a time
+    if job.state in ("done", "partial"):
+        results = await asyncio.to_thread(job.results, offset, limit)
+
+        status["results"] = results
+        status["offset"] = offset
+        status["next_offset"] = (
+            offset + len(results) if offset + len(results) < job.panels else None
+        )
+
+    return status
+
+
+@app.post("/scans/{id}/retry", status_code=202)
+async def retry_panel_scan(id: str):
+    require_segmentation()
+
+    job = await get_scan(id)
+
+    if job is None:
+        raise HTTPException(status_code=404, detail="Scan not found")
+
+    if job.state != "partial":
+        raise HTTPException(
+            status_code=409,
+            detail=f"Only partial scans are retried, the scan is {job.state}",
+        )
+
+    # The checkpointed tiles are skipped, so only the failed tiles are processed again
+    if not await retry_scan(job):
+        raise HTTPException(status_code=409, detail="The scan is already running")
+
+    return job.status()
+
+
+def require_forecast_days(days: int):
+    # The predictions cover today and tomorrow
+    if days < 2:
+        raise HTTPException(
+            status_code=503,
+            detail="Weather forecast does not cover today and tomorrow",
+        )
+
+
 @app.get("/predictions")
 async def predict_pv_energy(center: str, type: str):
+    if type not in MODULE_TYPES:
+        raise HTTPException(status_code=422, detail=f"Unknown module type {type}")
+
     # Get the weather forecast for the next 2 days
-    weather_data = get_predicted_data()
+    forecast = get_predicted_data()
+
+    if forecast is None:
+        raise HTTPException(status_code=503, detail="Weather forecast not available")
 
     # Get the azimuth and the tilt of the solar panels from the google api
-    roof_data = fetch_roof_information(center)
+    roof_data = await fetch_roof_information(center)
 
     if roof_data is None:
         raise HTTPException(status_code=404, detail="Roof data not found")
 
-    # Extend the weather data with the roof data
-    weather_data["azimuth"] = roof_data["azimuth"]
-    weather_data["tilt"] = roof_data["tilt"]
-    weather_data["module_type"] = type
+    # Interpolate the forecast at the location of the panel
+    lat, lng = map(float, center.split(","))
+    dynamic_features = await run_cpu(forecast.dynamic_features, lat, lng)
+    require_forecast_days(len(dynamic_features))
 
     # Run the inference model for the energy production
-    predictions = energy_prediction(weather_data)
+    predictions = await run_cpu(energy_prediction, dynamic_features, roof_data, type)
 
     # Return the normal parameters for the today and tomorrow
     return {
         "today": predictions[0],
         "tomorrow": predictions[1],
     }
+
+
+@app.post("/predictions/batch")
+async def predict_pv_energy_batch(request: PredictionBatchRequest):
+    if len(request.panels) > PREDICTION_BATCH_MAX_PANELS:
+        raise HTTPException(
+            status_code=422,
+            detail=f"The request has {len(request.panels)} panels, "
+            f"at most {PREDICTION_BATCH_MAX_PANELS} are allowed",
+        )
+
+    for panel in request.panels:
+        if panel.type not in MODULE_TYPES:
+            raise HTTPException(
+                status_code=422, detail=f"Unknown module type {panel.type}"
+            )
+
+    forecast = get_predicted_data()
+
+    if forecast is None:
+        raise HTTPException(status_code=503, detail="Weather forecast not available")
+
+    # Every distinct location is looked up once, and locations in the same roof cache
+    # bucket share a single upstream call. The building is only known from the answer of
+    # the Solar API, so panels of one building in different buckets each make a call.
+    centers = list(dict.fromkeys(panel.center for panel in request.panels))
+    roofs = dict(
+        zip(
+            centers,
+            await asyncio.gather(
+                *(fetch_roof_information(center) for center in centers)
+            ),
+        )
+    )
+
+    # Panels without roof data get no prediction, duplicated panels are predicted once
+    panels = list(
+        dict.fromkeys(
+            (panel.center, panel.type)
+            for panel in request.panels
+            if roofs[panel.center] is not None
+        )
+    )
+    predictions = {}
+
+    if panels:
+        locations = np.array([list(map(float, center.split(","))) for center, _ in panels])
+        statics = np.array(
+            [static_features(roofs[center], type) for center, type in panels]
+        )
+
+        # Interpolate the forecast at every panel and run a single forward pass
+        dynamic_features = await run_cpu(
+            forecast.dynamic_features_batch, locations[:, 0], locations[:, 1]
+        )
+        require_forecast_days(dynamic_features.shape[1])
+
+        curves = await run_cpu(energy_prediction_batch, dynamic_features, statics)
+
+        # The same days as /predictions, today followed by tomorrow
+        predictions = {
+            panel: {"today": curve[0].tolist(), "tomorrow": curve[1].tolist()}
+            for panel, curve in zip(panels, curves)
+        }
+
+    return {
+        "results": [
+            {
+                "center": panel.center,
+                "type": panel.type,
+                "predictions": predictions.get((panel.center, panel.type)),
+            }
+            for panel in request.panels
+        ],
+    }
+
+
+@app.get("/metrics")
+async def metrics():
+    # Queueing metrics of the inference executor and the upstream calls
+    return {
+        **executor_metrics(),
+        "tile_cache": tile_cache_metrics(),
+        "roof_cache": roof_cache_metrics(),
+        "coalesced": singleflight_metrics(),
+    }
@@ -0,0 +1,91 @@
+"""Report the memory of every worker of a running server, from /proc/<pid>/smaps_rollup.
+
+RSS counts the pages shared with other workers in full in every worker, PSS splits them
+evenly between the workers that map them, so the sum of the PSS of the workers is the
+memory the server really uses. Compare a server started with SEGMENTATION_MMAP_WEIGHTS=1
+with one started without it:
+
+    uvicorn main:app --workers 4 &
+    python -m server.measure_worker_memory $!
+"""
+
+import argparse
+import os
+
+# Fields of smaps_rollup that are reported, in kB
+FIELDS = [
+    "Rss",
+    "Pss",
+    "Shared_Clean",
+    "Shared_Dirty",
+    "Private_Clean",
+    "Private_Dirty",
+]
+
+
+def children(pid: int) -> list:
+    """The pids of the direct children of a process, over all of its threads."""
+
+    pids = []
+
+    for task in os.listdir(f"/proc/{pid}/task"):
+        with open(f"/proc/{pid}/task/{task}/children") as f:
+            pids.extend(int(child) for child in f.read().split())
+
+    return pids
+
+
+def memory(pid: int) -> dict:
+    """Read the memory of a process.
+
+    Args:
+        pid (int): The pid of the process.
+
+    Returns:
+        dict: The fields of smaps_rollup, in kB.
+    """
+
+    values = {}
+
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            name, _, value = line.partition(":")
+
+            if name in FIELDS:
+                values[name] = int(value.split()[0])
+
+    return values
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "pid", type=int, help="pid of the server, or of a single worker"
+    )
+    args = parser.parse_args()
+
+    # Uvicorn runs the workers as children of a supervisor process
+    pids = children(args.pid) or [args.pid]
+
+    print(f"{'pid':>8} " + " ".join(f"{field:>14}" for field in FIELDS))
+
+    totals = dict.fromkeys(FIELDS, 0)
+    for pid in pids:
+        values = memory(pid)
+
+        for field in FIELDS:
+            totals[field] += values.get(field, 0)
+
+        print(
+            f"{pid:>8} "
+            + " ".join(f"{values.get(field, 0) / 1024:11.1f} MB" for field in FIELDS)
+        )
+
+    print(
+        f"{'total':>8} "
+        + " ".join(f"{totals[field] / 1024:11.1f} MB" for field in FIELDS)
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+"""Inference-only artifacts of the trained models: the weights as a safetensors file,
+with the configuration needed to rebuild the architecture in the metadata of the same
+file. Loading them only needs torch and the architecture, not the training code,
+Lightning or the pickled hyperparameters of the checkpoints.
+
+The artifacts are written by "python -m server.export_models segmentation-artifact" and
+"python -m server.export_models energy-artifact".
+"""
+
+import json
+import struct
+import warnings
+
+import numpy as np
+import torch
+from safetensors import safe_open
+from safetensors.torch import load_file, save_file
+
+from server.energy_prediction_model import EnergyPredictionModel
+
+
+def save_artifact(model: torch.nn.Module, config: dict, path: str):
+    """Write the weights of a model and its configuration to a safetensors file.
+
+    Args:
+        model (torch.nn.Module): The trained model.
+        config (dict): The JSON serialisable arguments needed to rebuild the model.
+        path (str): The path of the safetensors file.
+    """
+
+    tensors = {
+        name: tensor.detach().cpu().contiguous()
+        for name, tensor in model.state_dict().items()
+    }
+
+    save_file(tensors, path, metadata={"config": json.dumps(config)})
+
+
+def load_artifact(path: str, device: str = "cpu") -> tuple:
+    """Read the weights and the configuration of a safetensors file.
+
+    Args:
+        path (str): The path of the safetensors file.
+        device (str): The device the weights are loaded on.
+
+    Returns:
+        tuple: The configuration and the state dict.
+    """
+
+    with safe_open(path, framework="pt") as f:
+        config = json.loads(f.metadata()["config"])
+
+    return config, load_file(path, device=device)
+
+
+# Numpy types of the safetensors dtypes that can be mapped
+SAFETENSORS_DTYPES = {
+    "F64": np.float64,
+    "F32": np.float32,
+    "F16": np.float16,
+    "I64": np.int64,
+    "I32": np.int32,
+    "I16": np.int16,
+    "I8": np.int8,
+    "U8": np.uint8,
+    "BOOL": np.bool_,
+}
+
+
+def map_artifact(path: str) -> tuple:
+    """Map the weights of a safetensors file read-only instead of reading them. The
+    tensors are views on the page cache, so every process that maps the same file shares
+    one copy of the weights. The tensors are for inference only: writing to them crashes
+    the process instead of raising an error.
+
+    Args:
+        path (str): The path of the safetensors file.
+
+    Returns:
+        tuple: The configuration and the state dict.
+    """
+
+    # The file starts with the length of its JSON header, followed by the raw tensors
+    with open(path, "rb") as f:
+        (header_size,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_size))
+
+    data = np.memmap(path, dtype=np.uint8, mode="r", offset=8 + header_size)
+    config = json.loads(header.pop("__metadata__")["config"])
+
+    state_dict = {}
+    for name, info in header.items():
+        start, end = info["data_offsets"]
+        array = (
+            data[start:end]
+            .view(SAFETENSORS_DTYPES[info["dtype"]])
+            .reshape(info["shape"])
+        )
+
+        # Torch warns that the array is not writable, which is what the mapping is for.
+        # The loaded model keeps the tensors out of autograd and of any training step.
+        with warnings.catch_warnings():
+            warnings.filterwarnings("ignore", message="The given NumPy array")
+            state_dict[name] = torch.from_numpy(array)
+
+    return config, state_dict
+
+
+def load_segmentation_artifact(
+    path: str, device: torch.device, mmap: bool = False
+) -> torch.nn.Module:
+    """Rebuild the DeepLabModel of a segmentation artifact.
+
+    Args:
+        path (str): The path of the safetensors file.
+        device (torch.device): The device the model runs on.
+        mmap (bool): Whether the weights are mapped from the file, so that the workers
+            of a server share them. Only used on the cpu.
+
+    Returns:
+        torch.nn.Module: The model in evaluation mode.
+    """
+
+    # Only imported here, so the energy model loads without the segmentation code
+    from models.architectures import DeepLabModel
+
+    def build_model() -> torch.nn.Module:
+        # The pretrained encoder weights would be overwritten by the artifact anyway
+        return DeepLabModel(
+            num_classes=config["num_classes"],
+            backbone=config["backbone"],
+            encoder_weights=None,
+        )
+
+    if mmap and device.type == "cpu":
+        config, state_dict = map_artifact(path)
+
+        # Built without storage, the parameters become the mapped tensors
+        with torch.device("meta"):
+            model = build_model()
+        model.load_state_dict(state_dict, assign=True)
+
+        # Inference only: no gradients are accumulated into the read-only parameters,
+        # and switching back to training, which updates the batch norm statistics in
+        # place, is refused
+        model.requires_grad_(False)
+        model.eval()
+
+        def train(mode: bool = True) -> torch.nn.Module:
+            if mode:
+                raise RuntimeError("The weights are mapped read-only")
+
+            return model
+
+        model.train = train
+
+        return model
+
+    config, state_dict = load_artifact(path, device=str(device))
+
+    model = build_model()
+    model.load_state_dict(state_dict)
+
+    return model.to(device).eval()
+
+
+def load_energy_prediction_artifact(path: str) -> EnergyPredictionModel:
+    """Rebuild the EnergyPredictionModel of an energy artifact, including the dataset
+    values of its normalisation.
+
+    Args:
+        path (str): The path of the safetensors file.
+
+    Returns:
+        EnergyPredictionModel: The model in evaluation mode.
+    """
+
+    config, state_dict = load_artifact(path)
+    dataset_values = config.pop("dataset_values")
+
+    model = EnergyPredictionModel(
+        **config,
+        dataset_values={
+            "mean": dataset_values["mean"],
+            "std": dataset_values["std"],
+            "output_mins": np.asarray(dataset_values["output_mins"]),
+            "output_maxs": np.asarray(dataset_values["output_maxs"]),
+        },
+    )
+    model.load_state_dict(state_dict)
+
+    return model.eval()
@@ -0,0 +1,61 @@
+import numpy as np
+import onnxruntime as ort
+
+GRAPH_OPTIMIZATION_LEVELS = {
+    "disable": ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    "basic": ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    "extended": ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    "all": ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
+
+class OnnxSegmentationModel:
+    """Runs the segmentation model exported by export_models.py with ONNX Runtime on the
+    cpu. It takes and returns plain arrays, so it does not depend on torch.
+
+    Args:
+        path (str): The path of the ONNX model.
+        intra_op_threads (int): Threads used within an operator, 0 lets ORT decide.
+        inter_op_threads (int): Threads used to run independent operators in parallel,
+            0 lets ORT decide.
+        optimization_level (str): The graph optimisation level, one of
+            GRAPH_OPTIMIZATION_LEVELS.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        intra_op_threads: int = 0,
+        inter_op_threads: int = 0,
+        optimization_level: str = "all",
+    ):
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = inter_op_threads
+        options.graph_optimization_level = GRAPH_OPTIMIZATION_LEVELS[optimization_level]
+
+        # Independent operators only run in parallel when asked for
+        options.execution_mode = (
+            ort.ExecutionMode.ORT_PARALLEL
+            if inter_op_threads > 1
+            else ort.ExecutionMode.ORT_SEQUENTIAL
+        )
+
+        self.session = ort.InferenceSession(
+            path, options, providers=["CPUExecutionProvider"]
+        )
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, images: np.ndarray) -> np.ndarray:
+        """Run a forward pass.
+
+        Args:
+            images (np.ndarray): The normalized images, as float32 of shape Bx3x640x640.
+
+        Returns:
+            np.ndarray: The logits of the masks, of shape Bx1x640x640.
+        """
+
+        images = np.ascontiguousarray(images, dtype=np.float32)
+
+        return self.session.run(None, {self.input_name: images})[0]
@@ -0,0 +1,178 @@
+import os
+import sqlite3
+import threading
+import time
+
+# Marker for a location that is known to have no roof information
+MISSING = object()
+
+
+def location_key(lat: float, lng: float, precision: int) -> str:
+    """Quantise the location so that nearby requests share a cache entry.
+
+    Args:
+        lat (float): The latitude.
+        lng (float): The longitude.
+        precision (int): The number of decimals kept, 4 decimals is about 10 meters.
+
+    Returns:
+        str: The cache key of the location.
+    """
+
+    return f"{lat:.{precision}f},{lng:.{precision}f}"
+
+
+class RoofCache:
+    """Cache for the roof information of the Solar API. Locations are mapped to the
+    building that was returned for them, and the roof information is stored once per
+    building. The building of a location is only known from the answer of the Solar API,
+    so every new location key still makes one upstream call, after which all panels in
+    that key are served from the cache. Locations without a building are cached as well,
+    so repeated misses do not reach the API either.
+
+    Entries are kept in memory and persisted in a SQLite database, so they survive a
+    restart of the server.
+
+    Args:
+        path (str): The path of the SQLite database.
+        ttl (float): Time in seconds before roof information is fetched again.
+        negative_ttl (float): Time in seconds before a location without a building is retried.
+    """
+
+    def __init__(self, path: str, ttl: float, negative_ttl: float):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+
+        self.lock = threading.Lock()
+        self.locations = {}
+        self.buildings = {}
+
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS locations "
+            "(key TEXT PRIMARY KEY, building_id TEXT, expires REAL)"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS buildings "
+            "(building_id TEXT PRIMARY KEY, azimuth REAL, tilt REAL, expires REAL)"
+        )
+        self.db.commit()
+
+        self._load()
+
+    def _load(self):
+        now = time.time()
+
+        self.db.execute("DELETE FROM locations WHERE expires < ?", (now,))
+        self.db.execute("DELETE FROM buildings WHERE expires < ?", (now,))
+        self.db.commit()
+
+        for key, building_id, expires in self.db.execute("SELECT * FROM locations"):
+            self.locations[key] = (building_id, expires)
+
+        for building_id, azimuth, tilt, expires in self.db.execute(
+            "SELECT * FROM buildings"
+        ):
+            self.buildings[building_id] = (
+                {"azimuth": azimuth, "tilt": tilt},
+                expires,
+            )
+
+    def get(self, key: str):
+        """Look up the roof information of a location.
+
+        Args:
+            key (str): The quantised location.
+
+        Returns:
+            The roof information, MISSING when the location is known to have no building,
+            or None when the location is not cached.
+        """
+
+        now = time.time()
+
+        with self.lock:
+            building_id, expires = self.locations.get(key, (None, 0))
+
+            if expires < now:
+                self.misses += 1
+                return None
+
+            if building_id is None:
+                self.negative_hits += 1
+                return MISSING
+
+            roof, expires = self.buildings.get(building_id, (None, 0))
+
+            if expires < now:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            return roof
+
+    def put(self, key: str, building_id: str, roof: dict):
+        """Store the roof information of a location.
+
+        Args:
+            key (str): The quantised location.
+            building_id (str): The id of the building returned by the Solar API.
+            roof (dict): The roof information of the building.
+        """
+
+        expires = time.time() + self.ttl
+
+        with self.lock:
+            self.locations[key] = (building_id, expires)
+            self.buildings[building_id] = (roof, expires)
+
+            self.db.execute(
+                "INSERT OR REPLACE INTO locations VALUES (?, ?, ?)",
+                (key, building_id, expires),
+            )
+            self.db.execute(
+                "INSERT OR REPLACE INTO buildings VALUES (?, ?, ?, ?)",
+                (building_id, roof["azimuth"], roof["tilt"], expires),
+            )
+            self.db.commit()
+
+    def put_missing(self, key: str):
+        """Remember that there is no roof information for a location.
+
+        Args:
+            key (str): The quantised location.
+        """
+
+        expires = time.time() + self.negative_ttl
+
+        with self.lock:
+            self.locations[key] = (None, expires)
+
+            self.db.execute(
+                "INSERT OR REPLACE INTO locations VALUES (?, NULL, ?)",
+                (key, expires),
+            )
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "negative_hits": self.negative_hits,
+                "misses": self.misses,
+                "locations": len(self.locations),
+                "buildings": len(self.buildings),
+            }
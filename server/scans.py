@@ -0,0 +1,510 @@
+import os
+import json
+import time
+import uuid
+import fcntl
+import bisect
+import asyncio
+import itertools
+import logging
+import threading
+
+import numpy as np
+
+from server.executors import run_cpu
+from server.google_maps_api import fetch_google_maps_static_image
+from server.inference import batched_segmentation_mask, postprocess_mask
+from server.area_segmentation import TileGrid, build_area_panels
+
+logger = logging.getLogger(__name__)
+
+# Folder with the description and the checkpointed progress of every scan
+SCANS_DIR = os.getenv("SCANS_DIR", "scans")
+# Maximum number of tiles a single scan may cover
+SCAN_MAX_TILES = int(os.getenv("SCAN_MAX_TILES", 100_000))
+# Maximum number of tiles waiting between two stages of the pipeline
+SCAN_QUEUE_SIZE = int(os.getenv("SCAN_QUEUE_SIZE", 32))
+# Concurrency of every stage of the pipeline
+SCAN_FETCH_CONCURRENCY = int(os.getenv("SCAN_FETCH_CONCURRENCY", 16))
+SCAN_INFERENCE_CONCURRENCY = int(os.getenv("SCAN_INFERENCE_CONCURRENCY", 16))
+SCAN_POSTPROCESS_CONCURRENCY = int(os.getenv("SCAN_POSTPROCESS_CONCURRENCY", 4))
+# Maximum number of panels returned by a single request for the results of a scan
+SCAN_RESULTS_PAGE_SIZE = int(os.getenv("SCAN_RESULTS_PAGE_SIZE", 1000))
+
+jobs = {}
+
+
+class ScanJob:
+    """A scan of the panels in a large area, run as a pipeline of stages connected by
+    bounded queues: tile enumeration, tile fetching, batched inference and post-processing.
+    Every stage runs at its own concurrency, and a full queue blocks the stage in front of
+    it, so the memory of a scan does not depend on its size.
+
+    Each tile keeps the panels whose center lies in its own region of the area, so panels
+    on the edge of a tile are found once. Unlike segment_area, masks are not merged across
+    tiles: a panel that reaches further than the overlap beyond the region of its tile is
+    clipped at the edge of the tile, and may be reported as two fragments. The panels of
+    every finished tile are appended to a checkpoint, from which an interrupted scan
+    resumes.
+
+    Args:
+        id (str): The id of the scan.
+        bounds (dict): The south, west, north and east edges of the area.
+        overlap (int): The pixels of context around the region owned by a tile.
+    """
+
+    def __init__(self, id: str, bounds: dict, overlap: int):
+        self.id = id
+        self.bounds = bounds
+        self.overlap = overlap
+        self.grid = TileGrid.from_bounds(**bounds, overlap=overlap)
+
+        self.state = "pending"
+        self.done = set()
+        self.panels = 0
+        self.fetched = 0
+        self.inferred = 0
+        self.failed = 0
+
+        self.started = None
+        self.processed = 0
+
+        # The panels before every checkpointed tile and the byte offset of its record,
+        # so a page of results is read without parsing the records in front of it
+        self.index = []
+        self.read_offset = 0
+
+        self.task: asyncio.Task = None
+        self.lock_file = None
+        self.write_lock = threading.Lock()
+
+    def _path(self, extension: str) -> str:
+        return os.path.join(SCANS_DIR, f"{self.id}.{extension}")
+
+    def acquire(self) -> bool:
+        """Try to become the worker that runs the scan, so a scan that is resumed after a
+        restart runs in a single worker.
+
+        Returns:
+            bool: Whether this worker runs the scan
+        """
+
+        lock_file = open(self._path("lock"), "w")
+
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return False
+
+        self.lock_file = lock_file
+
+        return True
+
+    def release(self):
+        if self.lock_file is not None:
+            self.lock_file.close()
+            self.lock_file = None
+
+    def save(self):
+        """Write the description and the state of the scan."""
+
+        description = {
+            "id": self.id,
+            "bounds": self.bounds,
+            "overlap": self.overlap,
+            "state": self.state,
+            "failed": self.failed,
+        }
+
+        tmp_path = f"{self._path('json')}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(description, f)
+        os.replace(tmp_path, self._path("json"))
+
+    def _read_description(self) -> dict | None:
+        try:
+            with open(self._path("json")) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def _add_record(self, offset: int, record: dict):
+        self.index.append((self.panels, offset))
+        self.done.add(tuple(record["tile"]))
+        self.panels += len(record["panels"])
+
+    def refresh(self):
+        """Read the state of the scan and the tiles checkpointed since the last refresh,
+        which another worker may have written.
+        """
+
+        description = self._read_description()
+
+        if description is not None:
+            self.state = description["state"]
+            self.failed = description["failed"]
+
+        with self.write_lock:
+            try:
+                f = open(self._path("jsonl"), "rb")
+            except FileNotFoundError:
+                return
+
+            with f:
+                f.seek(self.read_offset)
+
+                for line in f:
+                    # The record is still being written, it is read by the next refresh
+                    if not line.endswith(b"\n"):
+                        break
+
+                    try:
+                        self._add_record(self.read_offset, json.loads(line))
+                    except json.JSONDecodeError:
+                        # The line was cut off when the server died while writing
+                        pass
+
+                    self.read_offset += len(line)
+
+    @classmethod
+    def load(cls, id: str) -> "ScanJob | None":
+        """Restore a scan and its progress from the scans folder.
+
+        Args:
+            id (str): The id of the scan.
+
+        Returns:
+            ScanJob | None: The scan, None if there is no scan with the id
+        """
+
+        try:
+            with open(os.path.join(SCANS_DIR, f"{id}.json")) as f:
+                description = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+        job = cls(description["id"], description["bounds"], description["overlap"])
+        job.refresh()
+
+        return job
+
+    def records(self, start: int = 0):
+        """Iterate over the checkpointed tiles and their panels, from a byte offset."""
+
+        try:
+            with open(self._path("jsonl"), "rb") as f:
+                f.seek(start)
+
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except json.JSONDecodeError:
+                        # The last line is cut off when the server died while writing
+                        continue
+        except FileNotFoundError:
+            return
+
+    def results(self, offset: int = 0, limit: int | None = None) -> list:
+        """The panels found so far, every panel is listed once.
+
+        Args:
+            offset (int): The number of panels to skip.
+            limit (int | None): The maximum number of panels, None for all of them.
+
+        Returns:
+            list: The panels, in the order their tiles were checkpointed.
+        """
+
+        # The last record that starts at or before the offset
+        position = bisect.bisect_right(self.index, (offset, float("inf"))) - 1
+
+        if position < 0:
+            return []
+
+        before, start = self.index[position]
+        panels = (
+            panel for record in self.records(start) for panel in record["panels"]
+        )
+        skip = offset - before
+        stop = None if limit is None else skip + limit
+
+        return list(itertools.islice(panels, skip, stop))
+
+    def truncate(self):
+        """Drop a record that was cut off when the server died while writing it, so the
+        records appended from now on start on a line of their own.
+        """
+
+        with self.write_lock:
+            try:
+                os.truncate(self._path("jsonl"), self.read_offset)
+            except FileNotFoundError:
+                pass
+
+    def checkpoint(self, row: int, column: int, panels: list):
+        record = {"tile": [row, column], "panels": panels}
+
+        with self.write_lock:
+            with open(self._path("jsonl"), "ab") as f:
+                line = (json.dumps(record) + "\n").encode()
+                f.write(line)
+
+            # Only the worker that holds the lock of the scan appends to the file
+            self._add_record(self.read_offset, record)
+            self.read_offset += len(line)
+
+    def status(self) -> dict:
+        elapsed = time.monotonic() - self.started if self.started else 0
+
+        status = {
+            "id": self.id,
+            "state": self.state,
+            "bounds": self.bounds,
+            "tiles": {
+                "total": len(self.grid),
+                "done": len(self.done),
+                "failed": self.failed,
+            },
+            "panels": self.panels,
+        }
+
+        # Progress of the stages is only known to the worker that runs the scan
+        if self.task is not None:
+            status["tiles"]["fetched"] = self.fetched
+            status["tiles"]["inferred"] = self.inferred
+            status["tiles_per_second"] = self.processed / elapsed if elapsed else 0.0
+
+        return status
+
+    @property
+    def running(self) -> bool:
+        return self.task is not None and not self.task.done()
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+        self.release()
+
+    async def fetch(self, row: int, column: int) -> tuple:
+        image = await fetch_google_maps_static_image(self.grid.center(row, column))
+        self.fetched += 1
+
+        return row, column, image
+
+    async def infer(self, row: int, column: int, image: np.ndarray) -> tuple:
+        # The batcher stacks the tiles of the scan into large forward passes
+        mask = await batched_segmentation_mask(image)
+        self.inferred += 1
+
+        return row, column, image, mask
+
+    def _postprocess(self, row: int, column: int, image: np.ndarray, mask) -> list:
+        polygons, centers, pvtypes = postprocess_mask(image, mask)
+
+        # Panels are kept by the tile that owns their center, so none is found twice
+        owned = [
+            index
+            for index, center in enumerate(centers)
+            if self.grid.owns(row, column, *center)
+        ]
+
+        panels = build_area_panels(
+            self.grid.origin(row, column),
+            [polygons[index] for index in owned],
+            [centers[index] for index in owned],
+            [pvtypes[index] for index in owned],
+        )
+
+        self.checkpoint(row, column, panels)
+
+        return panels
+
+    async def postprocess(self, row: int, column: int, image: np.ndarray, mask):
+        panels = await run_cpu(self._postprocess, row, column, image, mask)
+
+        self.processed += 1
+
+    def stage(self, source: asyncio.Queue, sink: asyncio.Queue, fn, concurrency: int):
+        """Start the workers of a stage, which take items from source, call fn on them
+        and put the results in sink. A full sink blocks the workers.
+        """
+
+        async def worker():
+            while True:
+                item = await source.get()
+
+                try:
+                    result = await fn(*item)
+                except Exception:
+                    # The tile is not checkpointed, so a resumed scan retries it
+                    logger.exception(f"Scan {self.id} failed on tile {item[:2]}")
+                    self.failed += 1
+                    continue
+                finally:
+                    source.task_done()
+
+                if sink is not None:
+                    await sink.put(result)
+
+        return [asyncio.create_task(worker()) for _ in range(concurrency)]
+
+    async def run(self):
+        self.state = "running"
+        self.failed = 0
+        self.processed = 0
+        self.started = time.monotonic()
+        await asyncio.to_thread(self.save)
+        await asyncio.to_thread(self.truncate)
+
+        tiles = asyncio.Queue(SCAN_QUEUE_SIZE)
+        images = asyncio.Queue(SCAN_QUEUE_SIZE)
+        masks = asyncio.Queue(SCAN_QUEUE_SIZE)
+
+        workers = [
+            *self.stage(tiles, images, self.fetch, SCAN_FETCH_CONCURRENCY),
+            *self.stage(images, masks, self.infer, SCAN_INFERENCE_CONCURRENCY),
+            *self.stage(masks, None, self.postprocess, SCAN_POSTPROCESS_CONCURRENCY),
+        ]
+
+        # A scan that is cut off by a shutdown is resumed by the next start of the server
+        state = "pending"
+
+        try:
+            # Enumerate the tiles that are not checkpointed yet
+            for tile in self.grid.tiles():
+                if tile not in self.done:
+                    await tiles.put(tile)
+
+            # Every stage has put its results in the next queue once it is drained
+            for queue in [tiles, images, masks]:
+                await queue.join()
+
+            state = "done" if self.failed == 0 else "partial"
+        except Exception:
+            # The checkpointed tiles are kept, the others are processed by a retry
+            logger.exception(f"Scan {self.id} failed")
+            state = "partial"
+        finally:
+            for worker in workers:
+                worker.cancel()
+
+            self.state = state
+
+            # Saved in place, an await could be cancelled again during a shutdown
+            self.save()
+            self.release()
+
+        logger.info(f"Scan {self.id} is {self.state}, found {self.panels} panels")
+
+
+async def create_scan(bounds: dict, overlap: int) -> ScanJob:
+    """Create a scan of the area and start it in this worker.
+
+    Args:
+        bounds (dict): The south, west, north and east edges of the area.
+        overlap (int): The pixels of context around the region owned by a tile.
+
+    Returns:
+        ScanJob: The scan.
+    """
+
+    job = ScanJob(uuid.uuid4().hex, bounds, overlap)
+
+    # Only the files are written off the event loop, the scan itself runs on it
+    await asyncio.to_thread(job.save)
+    await asyncio.to_thread(job.acquire)
+
+    job.start()
+    jobs[job.id] = job
+
+    return job
+
+
+async def retry_scan(job: ScanJob) -> bool:
+    """Run a partial scan again, which only processes the tiles that failed.
+
+    Args:
+        job (ScanJob): The scan, whose state is "partial".
+
+    Returns:
+        bool: Whether the scan was restarted, False when another worker runs it
+    """
+
+    if job.running or not await asyncio.to_thread(job.acquire):
+        return False
+
+    # Pick up the tiles another worker may have checkpointed before it released the scan
+    await asyncio.to_thread(job.refresh)
+
+    job.start()
+    jobs[job.id] = job
+
+    return True
+
+
+async def get_scan(id: str) -> ScanJob | None:
+    """Get a scan, which may be run by another worker. Scans are kept once they are
+    loaded, so later requests only read the tiles checkpointed since.
+
+    Args:
+        id (str): The id of the scan.
+
+    Returns:
+        ScanJob | None: The scan, None if there is no scan with the id
+    """
+
+    job = jobs.get(id)
+
+    if job is None:
+        job = await asyncio.to_thread(ScanJob.load, id)
+
+        if job is None:
+            return None
+
+        job = jobs.setdefault(id, job)
+    elif not job.running:
+        # Another worker may run the scan, or may have retried it since
+        await asyncio.to_thread(job.refresh)
+
+    return job
+
+
+def load_scans():
+    """Resume the scans that were interrupted by a restart of the server."""
+
+    os.makedirs(SCANS_DIR, exist_ok=True)
+
+    for file_name in os.listdir(SCANS_DIR):
+        if not file_name.endswith(".json"):
+            continue
+
+        job = ScanJob.load(file_name[: -len(".json")])
+
+        if job is None or job.state not in ("pending", "running"):
+            continue
+
+        # Another worker may have resumed the scan already
+        if not job.acquire():
+            continue
+
+        logger.info(f"Resuming scan {job.id} at {len(job.done)}/{len(job.grid)} tiles")
+
+        job.start()
+        jobs[job.id] = job
+
+
+async def unload_scans():
+    for job in jobs.values():
+        await job.stop()
+
+    jobs.clear()
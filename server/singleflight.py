@@ -0,0 +1,69 @@
+import asyncio
+
+groups = {}
+
+
+class SingleFlight:
+    """Coalesces concurrent calls for the same key into a single call. The first caller
+    starts the call, every caller that arrives while it is in flight awaits the same
+    result instead of starting its own upstream call.
+
+    The call runs in its own task, so a caller that gives up waiting does not cancel it
+    for the others.
+
+    Args:
+        name (str): The name of the group, used in the metrics.
+    """
+
+    def __init__(self, name: str):
+        self.calls = {}
+        self.started = 0
+        self.coalesced = 0
+
+        groups[name] = self
+
+    async def do(self, key, fn, *args, **kwargs):
+        """Call the coroutine function unless a call for the key is already in flight.
+
+        Args:
+            key: The key identifying the call.
+            fn: The coroutine function to call.
+            *args: Passed on to fn.
+            **kwargs: Passed on to fn.
+
+        Returns:
+            The result of the call.
+        """
+
+        task = self.calls.get(key)
+
+        if task is not None:
+            self.coalesced += 1
+            return await asyncio.shield(task)
+
+        self.started += 1
+        task = asyncio.create_task(fn(*args, **kwargs))
+        self.calls[key] = task
+
+        def done(task: asyncio.Task):
+            if self.calls.get(key) is task:
+                del self.calls[key]
+
+            # Retrieve the exception so it is not reported when every caller gave up
+            if not task.cancelled():
+                task.exception()
+
+        task.add_done_callback(done)
+
+        return await asyncio.shield(task)
+
+    def stats(self) -> dict:
+        return {
+            "started": self.started,
+            "coalesced": self.coalesced,
+            "in_flight": len(self.calls),
+        }
+
+
+def singleflight_metrics() -> dict:
+    return {name: group.stats() for name, group in groups.items()}
@@ -0,0 +1,213 @@
+import io
+import os
+import logging
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+
+def tile_key(center: str, zoom: int, size: int) -> str:
+    """Build the cache key of a tile. The center is normalised so that the same location
+    written in different ways ends up in the same cache entry.
+
+    Args:
+        center (str): The center of the tile as "lat,lng".
+        zoom (int): The zoom level of the tile.
+        size (int): The size of the tile in pixels.
+
+    Returns:
+        str: The cache key, which is also safe to use as a file name.
+    """
+
+    lat, lng = map(float, center.split(","))
+
+    return f"{lat:.6f}_{lng:.6f}_z{zoom}_s{size}"
+
+
+def decode_image(data: bytes) -> np.ndarray:
+    """Decode the compressed image bytes straight from memory.
+
+    Args:
+        data (bytes): The compressed image.
+
+    Returns:
+        np.ndarray: The decoded image as a HxWx3 uint8 array.
+    """
+
+    with Image.open(io.BytesIO(data)) as image:
+        # Converting an image that is RGB already would only add a copy
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+
+        return np.array(image)
+
+
+class TileCache:
+    """Two tier cache for the satellite tiles. The disk tier keeps the compressed images
+    as they were downloaded and evicts the least recently used tiles once it grows over
+    max_bytes. The memory tier keeps the decoded arrays of the most recently used tiles.
+
+    The arrays returned by the cache are shared, so they must not be modified.
+
+    Args:
+        directory (str): The folder of the disk tier.
+        max_bytes (int): The maximum size of the disk tier in bytes.
+        memory_tiles (int): The maximum number of decoded tiles kept in memory.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, memory_tiles: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.memory_tiles = memory_tiles
+
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()
+        self.disk = OrderedDict()
+        self.disk_bytes = 0
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.png")
+
+    def _load_index(self):
+        # Restore the recency order of the tiles from a previous run
+        entries = []
+        for file_name in os.listdir(self.directory):
+            if not file_name.endswith(".png"):
+                continue
+
+            stat = os.stat(os.path.join(self.directory, file_name))
+            entries.append((stat.st_mtime, file_name[: -len(".png")], stat.st_size))
+
+        for _, key, size in sorted(entries):
+            self.disk[key] = size
+            self.disk_bytes += size
+
+        self._evict()
+
+    def _evict(self):
+        while self.disk_bytes > self.max_bytes and self.disk:
+            key, size = self.disk.popitem(last=False)
+            self.disk_bytes -= size
+
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def _remember(self, key: str, image: np.ndarray):
+        self.memory[key] = image
+        self.memory.move_to_end(key)
+
+        while len(self.memory) > self.memory_tiles:
+            self.memory.popitem(last=False)
+
+    def get_memory(self, key: str) -> np.ndarray | None:
+        """Look the tile up in the memory tier only, this never touches the disk.
+
+        Args:
+            key (str): The key of the tile.
+
+        Returns:
+            np.ndarray | None: The decoded tile, None if it is not in memory.
+        """
+
+        with self.lock:
+            image = self.memory.get(key)
+
+            if image is not None:
+                self.memory.move_to_end(key)
+                self.memory_hits += 1
+
+            return image
+
+    def get(self, key: str) -> np.ndarray | None:
+        """Look the tile up in the memory tier and then in the disk tier.
+
+        Args:
+            key (str): The key of the tile.
+
+        Returns:
+            np.ndarray | None: The decoded tile, None if it is not cached.
+        """
+
+        image = self.get_memory(key)
+
+        if image is not None:
+            return image
+
+        with self.lock:
+            if key not in self.disk:
+                self.misses += 1
+                return None
+
+            self.disk.move_to_end(key)
+
+        try:
+            with open(self._path(key), "rb") as f:
+                data = f.read()
+
+            # Keep the recency on disk up to date for the next restart
+            os.utime(self._path(key))
+        except FileNotFoundError:
+            with self.lock:
+                self.disk_bytes -= self.disk.pop(key, 0)
+                self.misses += 1
+            return None
+
+        image = decode_image(data)
+
+        with self.lock:
+            self.disk_hits += 1
+            self._remember(key, image)
+
+        return image
+
+    def put(self, key: str, data: bytes) -> np.ndarray:
+        """Store a downloaded tile in both tiers.
+
+        Args:
+            key (str): The key of the tile.
+            data (bytes): The compressed image as it was downloaded.
+
+        Returns:
+            np.ndarray: The decoded tile.
+        """
+
+        image = decode_image(data)
+
+        # Write to a temporary file first so a crash never leaves a partial tile behind
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+        with self.lock:
+            self.disk_bytes += len(data) - self.disk.pop(key, 0)
+            self.disk[key] = len(data)
+            self._evict()
+            self._remember(key, image)
+
+        return image
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "memory_tiles": len(self.memory),
+                "disk_tiles": len(self.disk),
+                "disk_bytes": self.disk_bytes,
+            }
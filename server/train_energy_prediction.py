@@ -0,0 +1,156 @@
+import torch
+from torch import nn
+import pytorch_lightning as pl
+import numpy as np
+
+from server.energy_prediction_model import EnergyPredictionModel
+
+
+class TrainEnergyPrediction(pl.LightningModule):
+    def __init__(
+        self,
+        dynamic_feature_size,
+        static_feature_size,
+        hidden_size,
+        fc_size,
+        learning_rate,
+        loss_type="mse",
+        dataset_values=None,
+    ):
+        super().__init__()
+        self.save_hyperparameters()
+        self.model = EnergyPredictionModel(
+            dynamic_feature_size,
+            static_feature_size,
+            hidden_size,
+            fc_size,
+            dropout_rate=0.1,
+            dataset_values=dataset_values,
+        )
+
+        if loss_type == "mse":
+            self.loss_fn = nn.MSELoss(reduction="sum")
+        elif loss_type == "l1":
+            self.loss_fn = nn.L1Loss(reduction="sum")
+        elif loss_type == "huber":
+            self.loss_fn = nn.HuberLoss(reduction="sum", delta=1.0)
+        else:
+            raise ValueError("Unsupported loss type. Choose from 'mse', 'l1', 'nll'.")
+
+        self.train_losses = []
+        self.validation_losses = []
+        self.test_losses = []
+        self.train_auc = []
+        self.validation_auc = []
+        self.train_r2 = []
+        self.val_r2 = []
+        self.learning_rate = learning_rate
+
+    def forward(self, x_dynamic, x_static):
+        return self.model(x_dynamic, x_static)
+
+    def training_step(self, batch, batch_idx):
+        x_dynamic, x_static, y_true = batch
+
+        y_pred = self(x_dynamic, x_static)
+
+        train_loss = self.loss_fn(y_pred, y_true)
+        self.train_losses.append(train_loss.item())
+        sum_loss = nn.L1Loss(reduction="sum")(y_pred, y_true)
+
+        # Calculate AUC for predictions and ground truth
+        auc_pred = self.calculate_auc(y_pred)
+        auc_gt = self.calculate_auc(y_true)
+        auc_ratio = auc_pred / auc_gt if auc_gt != 0 else 0
+
+        self.train_auc.append(auc_ratio.item())
+
+        # Calculate R^2 score
+        r2 = self.r2_score(y_true, y_pred)
+        self.train_r2.append(r2.item())
+
+        # Log metrics
+        self.log("train_auc", auc_ratio, on_step=True, on_epoch=True, logger=True)
+        self.log("train_loss", train_loss, on_step=True, on_epoch=True, logger=True)
+        self.log("train_l1_sum", sum_loss, on_step=False, on_epoch=True, logger=True)
+        self.log("train_r2_score", r2, on_step=True, on_epoch=True)
+
+        return train_loss
+
+    def validation_step(self, batch, batch_idx):
+        x_dynamic, x_static, y_true = batch
+        y_pred = self(x_dynamic, x_static)
+        val_loss = self.loss_fn(y_pred, y_true)
+        self.validation_losses.append(val_loss.item())
+        val_eval_metric = nn.L1Loss(reduction="mean")(y_pred, y_true)
+
+        # Calculate AUC for predictions and ground truth
+        auc_pred = self.calculate_auc(y_pred)
+        auc_gt = self.calculate_auc(y_true)
+        auc_ratio = auc_pred / auc_gt if auc_gt != 0 else 0
+
+        self.validation_auc.append(auc_ratio.item())
+
+        # Calculate R^2 score
+        r2 = self.r2_score(y_true, y_pred)
+        self.val_r2.append(r2.item())
+
+        # Log metrics
+        self.log("validation_auc", auc_ratio, on_step=True, on_epoch=True, logger=True)
+        self.log("val_train_loss", val_loss, on_step=False, on_epoch=True, logger=True)
+        self.log(
+            "val_evaluation_metric",
+            val_eval_metric,
+            on_step=False,
+            on_epoch=True,
+            logger=True,
+        )
+        self.log("val_r2_score", r2, on_step=True, on_epoch=True)
+
+        return val_eval_metric
+
+    def test_step(self, batch, batch_idx, dataloader_idx=0):
+        x_dynamic, x_static, y_true = batch
+        y_pred = self(x_dynamic, x_static)
+        test_loss = self.loss_fn(y_pred, y_true)
+        sum_loss = nn.L1Loss(reduction="sum")(y_pred, y_true)
+
+        # Calculate AUC for predictions and ground truth
+        auc_pred = self.calculate_auc(y_pred)
+        auc_gt = self.calculate_auc(y_true)
+        auc_ratio = auc_pred / auc_gt if auc_gt != 0 else 0
+
+        # Calculate R^2 score
+        r2 = self.r2_score(y_true, y_pred)
+
+        # Log metrics
+        self.log("Total test_loss", test_loss)
+        self.log("Total L1 loss", sum_loss)
+        self.log("Total auc_ratio", auc_ratio)
+        self.log(
+            "test_r2_score",
+            r2,
+        )
+        self.test_losses.append(test_loss.item())
+
+        return {
+            "test_loss": test_loss,
+            "sum_l1_loss": sum_loss,
+            "auc_ratio": auc_ratio,
+            "test_r2_score": r2,
+        }
+
+    def configure_optimizers(self):
+        optimizer = torch.optim.Adam(self.model.parameters(), lr=self.learning_rate)
+        return optimizer
+
+    def calculate_auc(self, y_values):
+        y_values = y_values.detach().numpy()
+        auc = np.trapz(y_values, axis=1)
+        return np.mean(auc)
+
+    def r2_score(self, y_true, y_pred):
+        ss_res = torch.sum((y_true - y_pred) ** 2)
+        ss_tot = torch.sum((y_true - torch.mean(y_true)) ** 2)
+        r2 = 1 - ss_res / ss_tot
+        return r2
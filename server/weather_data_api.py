@@ -1,25 +1,64 @@
 import pygrib
-import pandas as pd
 import numpy as np
 import os
 import shutil
 import tarfile
 import logging
-import sys
-import requests
-from datetime import datetime, timedelta
-
-from pvlib import irradiance
-from pvlib import irradiance, solarposition
+import asyncio
+import re
+import fcntl
+import queue
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Tuple
+
+from server import http_client
+from server.forecast import Forecast, GridIndex
+from server.singleflight import SingleFlight
 
 logging.basicConfig()
 logger = logging.getLogger(__name__)
 logger.setLevel(os.environ.get("LOG_LEVEL", logging.INFO))
 
-EINDHOVEN_LAT = 51.4416
-EINDHOVEN_LON = 5.4697
 DATASET_NAME = "harmonie_arome_cy40_p1"
 DATASET_VERSION = "0.2"
+WEATHER_DATA_DIR = "weather_data"
+# Holds the name of the run every worker should serve
+CURRENT_RUN_FILE = os.path.join(WEATHER_DATA_DIR, "current")
+
+# List needed parameters, see code matrix KNMI
+GRIB_PARAMETERS = {
+    "temperature": "11",
+    "windU": "33",
+    "windV": "34",
+    "globalRadiation": "117",
+}
+# Number of processes parsing grib files in parallel
+GRIB_WORKERS = int(os.getenv("GRIB_WORKERS", os.cpu_count() or 1))
+# Either "stream" to parse the run while it downloads, or "extract" to download the tar
+# file and extract it to disk first
+KNMI_INGEST_MODE = os.getenv("KNMI_INGEST_MODE", "stream")
+
+# Spatial index per grid, see load_grid
+grids = {}
+
+# Seconds between polls for a new run, once a new run is expected
+FORECAST_POLL_INTERVAL = float(os.getenv("FORECAST_POLL_INTERVAL", 15 * 60))
+# Seconds between checks whether another worker published a new run
+FORECAST_WATCH_INTERVAL = float(os.getenv("FORECAST_WATCH_INTERVAL", 30))
+# Time between the start of a run and the moment it is published by KNMI
+FORECAST_AVAILABILITY_DELAY = timedelta(
+    hours=float(os.getenv("FORECAST_AVAILABILITY_DELAY_HOURS", 3))
+)
+
+forecast: Forecast = None
+refresh_task: asyncio.Task = None
+refresh_lock = None
+
+# Concurrent refreshes of the same run share a single download
+forecast_flights = SingleFlight("forecasts")
 
 
 class OpenDataAPI:
@@ -29,22 +68,25 @@ class OpenDataAPI:
         self.base_url = "https://api.dataplatform.knmi.nl/open-data/v1"
         self.headers = {"Authorization": api_token}
 
-    def __get_data(self, url, params=None):
-        return requests.get(url, headers=self.headers, params=params).json()
+    async def __get_data(self, url, params=None):
+        res = await http_client.request("GET", url, headers=self.headers, params=params)
+        return res.json()
 
-    def list_files(self, dataset_name: str, dataset_version: str, params: dict):
-        return self.__get_data(
+    async def list_files(self, dataset_name: str, dataset_version: str, params: dict):
+        return await self.__get_data(
             f"{self.base_url}/datasets/{dataset_name}/versions/{dataset_version}/files",
             params=params,
         )
 
-    def get_file_url(self, dataset_name: str, dataset_version: str, file_name: str):
-        return self.__get_data(
+    async def get_file_url(
+        self, dataset_name: str, dataset_version: str, file_name: str
+    ):
+        return await self.__get_data(
             f"{self.base_url}/datasets/{dataset_name}/versions/{dataset_version}/files/{file_name}/url"
         )
 
 
-def download_file_from_temporary_download_url(download_url: str, filename: str):
+async def download_file_from_temporary_download_url(download_url: str, filename: str):
     """Download a file from a temporary download URL generated by the KNMI API.
 
     Args:
@@ -53,14 +95,13 @@ def download_file_from_temporary_download_url(download_url: str, filename: str):
     """
 
     try:
-        with requests.get(download_url, stream=True) as r:
-            r.raise_for_status()
+        async with http_client.stream("GET", download_url) as r:
             with open(filename, "wb") as f:
-                for chunk in r.iter_content(chunk_size=8192):
+                async for chunk in r.aiter_bytes(chunk_size=1 << 20):
                     f.write(chunk)
     except Exception:
         logger.exception("Unable to download file using download URL")
-        sys.exit(1)
+        raise
 
     logger.info(f"Successfully downloaded dataset file to {filename}")
 
@@ -91,170 +132,459 @@ def unpack_tar_file(tar_path: str) -> str:
     return dest_folder
 
 
-def read_grib_folder(grib_folder: str) -> pd.DataFrame:
-    """Read all grib files in a folder and extract the weather data for Eindhoven.
+def grid_signature(message: pygrib.gribmessage) -> tuple:
+    """Identify the grid of a grib message from its header, without decoding the grid.
 
     Args:
-        grib_folder (str): Path to the folder containing the grib files
+        message (pygrib.gribmessage): The grib message
 
     Returns:
-        pd.DataFrame: DataFrame containing the weather data for Eindhoven
+        tuple: The size and the corners of the grid
     """
 
-    # Currently only Eindhoven weather data is supported
-    global EINDHOVEN_LON, EINDHOVEN_LAT
-
-    # List needed parameters, see code matrix KNMI
-    parameters = {
-        "temperature": "11",
-        "windU": "33",
-        "windV": "34",
-        "globalRadiation": "117",
-    }
-
-    # Initialize list to hold the data
-    data_list = []
-
-    # Loop over each file
-    for file_name in os.listdir(grib_folder):
-        if file_name.endswith("_GB"):
-            grib_file = os.path.join(grib_folder, file_name)
-            grbs = pygrib.open(grib_file)
-
-            # Retrieve the lat/lon grid
-            first_message = grbs.message(1)
-            lats, lons = first_message.latlons()
-
-            # Find the closest grid point
-            distance = np.sqrt(
-                (lats - EINDHOVEN_LAT) ** 2 + (lons - EINDHOVEN_LON) ** 2
-            )
-            min_index = distance.argmin()
+    return (
+        message["Ni"],
+        message["Nj"],
+        message["latitudeOfFirstGridPointInDegrees"],
+        message["longitudeOfFirstGridPointInDegrees"],
+        message["latitudeOfLastGridPointInDegrees"],
+        message["longitudeOfLastGridPointInDegrees"],
+    )
+
+
+def load_grid(message: pygrib.gribmessage) -> GridIndex:
+    """Build the spatial index over the grid of a grib message. The index only depends
+    on the grid, so it is built once per grid and cached.
+
+    Args:
+        message (pygrib.gribmessage): A grib message on the grid
+
+    Returns:
+        GridIndex: The index over the grid
+    """
+
+    key = grid_signature(message)
+
+    if key not in grids:
+        lats, lons = message.latlons()
+        grids[key] = GridIndex(lats, lons)
+
+    return grids[key]
+
 
-            data_date = str(first_message.dataDate)  # Format: YYYYMMDD
-            data_time = first_message.dataTime  # Format: HHMM
+def extract_grib_data(file_name: str, messages) -> dict:
+    """Extract the full fields of the needed parameters from the messages of a grib
+    file. Only the messages of the needed parameters are decoded.
+
+    Args:
+        file_name (str): The name of the grib file
+        messages: Iterable over the grib messages of the file
+
+    Returns:
+        dict: The valid datetime and the field of every parameter in GRIB_PARAMETERS
+    """
+
+    data_dict = None
+    wanted = {code: name for name, code in GRIB_PARAMETERS.items()}
+
+    for message in messages:
+        if data_dict is None:
+            data_date = str(message.dataDate)  # Format: YYYYMMDD
+            data_time = message.dataTime  # Format: HHMM
 
             # Create the base datetime object from dataDate and dataTime
             base_datetime = datetime.strptime(
                 f"{data_date} {data_time:04d}", "%Y%m%d %H%M"
             )
-            step_range = float(first_message.stepRange)
+            step_range = float(message.stepRange)
             valid_datetime = base_datetime + timedelta(hours=step_range)
 
-            # Initialize a dictionary to hold the data for this file
+            # Initialize a dictionary to hold the data for this file, parameters that
+            # are not found in the grib file stay None
             data_dict = {
                 "file_name": file_name,
                 "datetime": valid_datetime,
+                **{param_name: None for param_name in GRIB_PARAMETERS},
             }
 
-            # Extract data for each parameter
-            for param_name in parameters:
-                try:
-                    grb_message = grbs.select(parameterName=parameters[param_name])[
-                        0
-                    ]  # First instance
-                    eindhoven_value = grb_message.values.flat[min_index]
-                    data_dict[param_name] = eindhoven_value
-                except (IndexError, ValueError):
-                    data_dict[param_name] = (
-                        np.nan
-                    )  # When parameter is not found in grib file
-
-            grbs.close()
-
-            # Append dictionary to list
-            data_list.append(data_dict)
-
-    # Convert list of dictionaries to DF
-    weather_df = pd.DataFrame(data_list)
-
-    weather_df["windSpeed"] = np.sqrt(
-        weather_df["windU"] ** 2 + weather_df["windV"] ** 2
-    )
+        # Only the first instance of every parameter is used
+        param_name = wanted.pop(message.parameterName, None)
 
-    # Convert temperature from Kelvin to Celsius
-    weather_df["temperature"] = weather_df["temperature"] - 272.15
-
-    weather_df["globalRadiation"] = weather_df["globalRadiation"].fillna(0)
-    # Calculate the difference between consecutive rows
-    weather_df["Q"] = weather_df["globalRadiation"].diff()
-    weather_df["Q"] = weather_df["Q"] / 3600
-
-    # Get solar position for the dates / times
-    solpos_df = solarposition.get_solarposition(
-        weather_df["datetime"],
-        latitude=EINDHOVEN_LAT,
-        longitude=EINDHOVEN_LON,
-        altitude=0,
-        temperature=weather_df["temperature"],
+        if param_name is not None:
+            data_dict[param_name] = np.ma.filled(message.values, np.nan).astype(
+                np.float32
+            )
+
+        if not wanted:
+            break
+
+    return data_dict
+
+
+def read_grib_file(grib_file: str) -> dict:
+    """Read the needed fields from a grib file on disk.
+
+    Args:
+        grib_file (str): Path to the grib file
+
+    Returns:
+        dict: The valid datetime and the field of every parameter in GRIB_PARAMETERS
+    """
+
+    grbs = pygrib.open(grib_file)
+
+    try:
+        return extract_grib_data(os.path.basename(grib_file), grbs)
+    finally:
+        grbs.close()
+
+
+def split_grib_messages(data: bytes, parameters: set = None):
+    """Split a buffer holding a grib file into its messages, without decoding them.
+
+    Args:
+        data (bytes): The contents of the grib file
+        parameters (set, optional): Only yield the first message and the GRIB1 messages
+            of these parameter numbers. Defaults to None, which yields every message.
+
+    Yields:
+        bytes: The encoded messages
+    """
+
+    offset = data.find(b"GRIB")
+    first = True
+
+    while offset != -1:
+        edition = data[offset + 7]
+
+        if edition == 1:
+            length = int.from_bytes(data[offset + 4 : offset + 7], "big")
+            # Octet 9 of the product definition section is the parameter number
+            parameter = data[offset + 16]
+        else:
+            length = int.from_bytes(data[offset + 8 : offset + 16], "big")
+            parameter = None
+
+        if first or parameters is None or parameter is None or parameter in parameters:
+            yield data[offset : offset + length]
+
+        first = False
+        offset = data.find(b"GRIB", offset + length)
+
+
+def read_grib_buffer(file_name: str, data: bytes) -> dict:
+    """Read the needed fields from a grib file in memory.
+
+    Args:
+        file_name (str): The name of the grib file
+        data (bytes): The contents of the grib file
+
+    Returns:
+        dict: The valid datetime and the field of every parameter in GRIB_PARAMETERS
+    """
+
+    parameters = {int(code) for code in GRIB_PARAMETERS.values()}
+    messages = (
+        pygrib.fromstring(message)
+        for message in split_grib_messages(data, parameters)
     )
-    solpos_df.index = weather_df.index
 
-    # Method 'Erbs' to go from GHI to DNI and DHI
-    irradiance_df = irradiance.erbs(
-        weather_df["Q"], solpos_df["zenith"], weather_df.index
+    return extract_grib_data(file_name, messages)
+
+
+class ChunkReader:
+    """File like object reading the chunks of a download that are fed to it from the
+    event loop. The queue between both sides is bounded, so a slow reader slows down the
+    download instead of buffering it in memory.
+
+    Args:
+        max_chunks (int, optional): Maximum number of chunks buffered. Defaults to 16.
+    """
+
+    def __init__(self, max_chunks: int = 16):
+        self.chunks = queue.Queue(maxsize=max_chunks)
+        self.buffer = bytearray()
+        self.eof = False
+
+    def feed(self, chunk, timeout: float) -> bool:
+        """Queue a chunk, None marks the end of the download and an exception aborts
+        the reader.
+
+        Returns:
+            bool: Whether the chunk was queued within the timeout.
+        """
+
+        try:
+            self.chunks.put(chunk, timeout=timeout)
+        except queue.Full:
+            return False
+
+        return True
+
+    def abort(self, error: Exception):
+        """Make the next read raise the error, without waiting for room in the queue.
+        Chunks that were not read yet are dropped.
+        """
+
+        while True:
+            try:
+                self.chunks.put_nowait(error)
+                return
+            except queue.Full:
+                try:
+                    self.chunks.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def read(self, size: int = -1) -> bytes:
+        while not self.eof and (size < 0 or len(self.buffer) < size):
+            chunk = self.chunks.get()
+
+            if chunk is None:
+                self.eof = True
+            elif isinstance(chunk, BaseException):
+                raise chunk
+            else:
+                self.buffer += chunk
+
+        if size < 0:
+            size = len(self.buffer)
+
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+
+        return data
+
+
+def read_grib_stream(reader: ChunkReader) -> Tuple[list, GridIndex]:
+    """Read the grib files straight from a tar stream. Members are handed to a pool of
+    GRIB_WORKERS processes as soon as they are read, and nothing is written to disk.
+
+    Args:
+        reader (ChunkReader): The stream of the tar file
+
+    Returns:
+        Tuple[list, GridIndex]: The extracted data of every grib file and their grid
+    """
+
+    grid = None
+    futures = []
+
+    # The pool keeps the data of a file until it is parsed, so at most two files per
+    # worker are read ahead. A slow parser then stops reading, which slows the download.
+    in_flight = threading.BoundedSemaphore(GRIB_WORKERS * 2)
+
+    # forkserver avoids forking the threads of the server into the workers
+    with ProcessPoolExecutor(
+        max_workers=GRIB_WORKERS,
+        mp_context=multiprocessing.get_context("forkserver"),
+    ) as pool:
+        with tarfile.open(fileobj=reader, mode="r|*") as tar:
+            for member in tar:
+                # Other members are skipped without being read into memory
+                if not member.isfile() or not member.name.endswith("_GB"):
+                    continue
+
+                in_flight.acquire()
+                data = tar.extractfile(member).read()
+
+                # All the files of a run share the same grid
+                if grid is None:
+                    first_message = next(split_grib_messages(data))
+                    grid = load_grid(pygrib.fromstring(first_message))
+
+                future = pool.submit(
+                    read_grib_buffer, os.path.basename(member.name), data
+                )
+                future.add_done_callback(lambda _: in_flight.release())
+                futures.append(future)
+
+        return [future.result() for future in futures], grid
+
+
+async def stream_grib_run(download_url: str) -> Tuple[list, GridIndex]:
+    """Download a HARMONIE run and parse the grib files while the tar file is still
+    downloading.
+
+    Args:
+        download_url (str): The temporary download URL
+
+    Returns:
+        Tuple[list, GridIndex]: The extracted data of every grib file and their grid
+    """
+
+    reader = ChunkReader()
+    parser = asyncio.create_task(asyncio.to_thread(read_grib_stream, reader))
+
+    async def feed(chunk) -> bool:
+        # Wait for room in the queue, unless the parser stopped reading
+        while not await asyncio.to_thread(reader.feed, chunk, 1.0):
+            if parser.done():
+                return False
+
+        return True
+
+    try:
+        async with http_client.stream("GET", download_url) as r:
+            async for chunk in r.aiter_bytes(chunk_size=1 << 20):
+                if not await feed(chunk):
+                    break
+
+        await feed(None)
+    except BaseException as e:
+        if isinstance(e, Exception):
+            logger.exception("Unable to download file using download URL")
+            error = e
+        else:
+            # Cancelled, for example at shutdown
+            error = RuntimeError("The download of the run was cancelled")
+
+        # The parser would otherwise wait for the next chunk forever
+        reader.abort(error)
+
+        try:
+            await parser
+        except Exception:
+            # The parser fails because of the abort, the download error is raised
+            pass
+
+        raise
+
+    data_list, grid = await parser
+
+    logger.info(f"Successfully streamed {len(data_list)} grib files")
+
+    return data_list, grid
+
+
+def read_grib_folder(grib_folder: str) -> Tuple[list, GridIndex]:
+    """Read all grib files in a folder. The files are parsed in parallel by a pool of
+    GRIB_WORKERS processes.
+
+    Args:
+        grib_folder (str): Path to the folder containing the grib files
+
+    Returns:
+        Tuple[list, GridIndex]: The extracted data of every grib file and their grid
+    """
+
+    grib_files = sorted(
+        os.path.join(grib_folder, file_name)
+        for file_name in os.listdir(grib_folder)
+        if file_name.endswith("_GB")
     )
-    irradiance_df["ghi"] = weather_df["Q"]
 
-    # Add DNI and DHI to weather_df
-    weather_df["dni"] = irradiance_df["dni"]
-    weather_df["dhi"] = irradiance_df["dhi"]
+    # All the files of a run share the same grid
+    grbs = pygrib.open(grib_files[0])
+    try:
+        grid = load_grid(grbs.message(1))
+    finally:
+        grbs.close()
 
-    df = weather_df.copy()
-    df = df.drop(["windU", "windV"], axis=1)
-    df = df[:-1]
-    df = df.fillna(0)
+    # forkserver avoids forking the threads of the server into the workers
+    with ProcessPoolExecutor(
+        max_workers=GRIB_WORKERS,
+        mp_context=multiprocessing.get_context("forkserver"),
+    ) as pool:
+        data_list = list(pool.map(read_grib_file, grib_files))
 
     # Remove the folder with the grib files
     shutil.rmtree(grib_folder)
 
-    return df
+    return data_list, grid
 
 
-def rename_columns_and_cache(df: pd.DataFrame) -> pd.DataFrame:
-    """Group the weather data by day and cache it in a CSV file.
+def build_forecast(run: str, data_list: list, grid: GridIndex) -> Forecast:
+    """Stack the fields read from the grib files into the forecast cube.
 
     Args:
-        df (pd.DataFrame): The full dataframe containing the weather data for Eindhoven per hour
+        run (str): The name of the KNMI file the data was read from
+        data_list (list): The extracted data of every grib file
+        grid (GridIndex): The grid of the fields
 
     Returns:
-        pd.DataFrame: The weather data grouped by day
+        Forecast: The forecast of the run
     """
 
-    df = df.sort_values("datetime")
-    date = df["datetime"].iloc[0].date()
-    df = df.drop(["file_name"], axis=1)
+    # The steps have to be in time order for the difference of the radiation
+    data_list = sorted(data_list, key=lambda data: data["datetime"])
+    missing = np.full(grid.shape, np.nan, dtype=np.float32)
+
+    def field(param_name: str) -> np.ndarray:
+        return np.stack(
+            [
+                data[param_name] if data[param_name] is not None else missing
+                for data in data_list
+            ]
+        )
+
+    wind_speed = np.sqrt(field("windU") ** 2 + field("windV") ** 2)
 
-    # Aggregate hourly values into lists per day
-    keeps = {
-        "temperature": "temperature_sequence",
-        "windSpeed": "wind_speed_sequence",
-        "dni": "dni_sequence",
-        "dhi": "dhi_sequence",
-        "globalRadiation": "global_irradiance_sequence",
-    }
-    df = df.rename(keeps, axis=1)
-    df = df.set_index("datetime")
+    # Convert temperature from Kelvin to Celsius
+    temperature = field("temperature") - 272.15
 
-    # Save it in a way that can be cached
-    df.to_csv(f"weather_data/{date}.csv")
+    global_radiation = np.nan_to_num(field("globalRadiation"))
 
-    return df
+    # Layout is (variable, lead time, y, x), in the order of VARIABLES
+    cube = np.stack([temperature, wind_speed, global_radiation]).astype(np.float32)
 
+    return Forecast(
+        run=run,
+        times=np.array([data["datetime"] for data in data_list], dtype="datetime64[s]"),
+        cube=cube,
+        grid=grid,
+    )
 
-def fetch_data_from_api() -> pd.DataFrame:
-    """Fetch the latest weather data from the KNMI API and cache it.
+
+def publish_forecast(forecast: Forecast) -> Forecast:
+    """Save the forecast in the shared weather data folder and make it the current run
+    for every worker. The current run is switched by atomically replacing the pointer
+    file, so workers never map a partially written run.
+
+    Args:
+        forecast (Forecast): The forecast to publish
 
     Returns:
-        pd.DataFrame: The weather data for Eindhoven grouped by day
+        Forecast: The published forecast, mapped from disk
     """
 
-    global DATASET_NAME, DATASET_VERSION
+    os.makedirs(WEATHER_DATA_DIR, exist_ok=True)
+    directory = os.path.join(WEATHER_DATA_DIR, forecast.run)
 
-    api_key = os.getenv("KNMI_API_KEY")
-    # For this its ok to launch a connection to the API every time
-    # because there wont be many requests
-    api = OpenDataAPI(api_token=api_key)
+    if not os.path.exists(directory):
+        forecast.save(directory)
+
+    tmp_pointer = f"{CURRENT_RUN_FILE}.tmp-{os.getpid()}"
+    with open(tmp_pointer, "w") as f:
+        f.write(forecast.run)
+    os.replace(tmp_pointer, CURRENT_RUN_FILE)
+
+    # Workers that still map an older run keep their mapping after the files are removed.
+    # Only the leader saves runs, so temporary folders are left behind by crashed saves.
+    for file_name in os.listdir(WEATHER_DATA_DIR):
+        path = os.path.join(WEATHER_DATA_DIR, file_name)
+
+        if (
+            (file_name.endswith(".tar") or ".tmp-" in file_name)
+            and file_name != forecast.run
+            and os.path.isdir(path)
+        ):
+            shutil.rmtree(path, ignore_errors=True)
+
+    return Forecast.load(directory)
+
+
+async def find_latest_file(api: OpenDataAPI) -> str | None:
+    """Find the name of the latest 00 run of the HARMONIE model.
+
+    Args:
+        api (OpenDataAPI): The KNMI API.
+
+    Returns:
+        str | None: The name of the latest file, None if it could not be found
+    """
+
+    global DATASET_NAME, DATASET_VERSION
 
     # Fetch the latest 4 files and order them by creation date
     params = {"maxKeys": 4, "orderBy": "created", "sorting": "desc"}
@@ -262,12 +592,12 @@ def fetch_data_from_api() -> pd.DataFrame:
     logger.info(f"Fetching latest file of {DATASET_NAME} version {DATASET_VERSION}")
 
     # Sort the files in descending order and only retrieve the first file
-    response = api.list_files(DATASET_NAME, DATASET_VERSION, params)
+    response = await api.list_files(DATASET_NAME, DATASET_VERSION, params)
 
     # Warn if there was an error in the response
     if "error" in response:
         logger.error(f"Unable to retrieve list of files: {response['error']}")
-        return
+        return None
 
     # Filter files that end with '00.tar'
     filtered_files = [
@@ -276,75 +606,257 @@ def fetch_data_from_api() -> pd.DataFrame:
 
     if not filtered_files:
         logger.error("No files ending with '00.tar' found")
-        return
+        return None
 
     # Assuming files are already sorted by creation date in the response, get the latest
-    latest_file = filtered_files[0].get("filename")
+    return filtered_files[0].get("filename")
+
+
+async def fetch_data_from_api(api: OpenDataAPI, latest_file: str) -> Forecast:
+    """Download and parse the given run of the HARMONIE model.
+
+    Args:
+        api (OpenDataAPI): The KNMI API.
+        latest_file (str): The name of the file to download.
+
+    Returns:
+        Forecast: The forecast of the run
+    """
+
+    global DATASET_NAME, DATASET_VERSION
+
     logger.info(f"Latest file is: {latest_file}")
 
-    # Fetch the download url and download the tar file
-    response = api.get_file_url(DATASET_NAME, DATASET_VERSION, latest_file)
-    download_file_from_temporary_download_url(
-        response["temporaryDownloadUrl"], latest_file
-    )
+    response = await api.get_file_url(DATASET_NAME, DATASET_VERSION, latest_file)
 
-    # Untar the file into a directory
-    logger.info(f"Unpacking {latest_file}")
+    if KNMI_INGEST_MODE == "stream":
+        logger.info(f"Streaming {latest_file} and extracting data")
 
-    grib_folder = unpack_tar_file(latest_file)
+        # Parse the grib files while the tar file is downloading
+        data_list, grid = await stream_grib_run(response["temporaryDownloadUrl"])
+    else:
+        # Download the tar file
+        await download_file_from_temporary_download_url(
+            response["temporaryDownloadUrl"], latest_file
+        )
 
-    logger.info("Reading grib files and extracting data")
+        # Untar the file into a directory
+        logger.info(f"Unpacking {latest_file}")
 
-    # Read the grib files and extract the data
-    daily_data = read_grib_folder(grib_folder)
+        # Unpacking and parsing are blocking, so they run in a thread
+        grib_folder = await asyncio.to_thread(unpack_tar_file, latest_file)
 
-    logger.info("Renaming the columns and caching it")
+        logger.info("Reading grib files and extracting data")
 
-    # Group the data by date and cache it
-    daily_data = rename_columns_and_cache(daily_data)
+        # Read the grib files and extract the data
+        data_list, grid = await asyncio.to_thread(read_grib_folder, grib_folder)
 
-    return daily_data
+    logger.info("Building the forecast and caching it")
 
+    forecast = await asyncio.to_thread(build_forecast, latest_file, data_list, grid)
 
-def get_cached_data(today: datetime) -> pd.DataFrame | None:
-    """Check if the data for today is cached and return it if it is.
+    # Workers map the published run instead of keeping their own copy
+    return await asyncio.to_thread(publish_forecast, forecast)
 
-    Args:
-        today (datetime): The current date
+
+def current_run() -> str | None:
+    """Read the name of the run that is currently published.
+
+    Returns:
+        str | None: The name of the run, None if no run was published yet
+    """
+
+    try:
+        with open(CURRENT_RUN_FILE) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def load_current_forecast() -> Forecast | None:
+    """Map the forecast of the run that is currently published.
+
+    Returns:
+        Forecast | None: The forecast, None if no run was published yet
+    """
+
+    run = current_run()
+
+    if run is None:
+        return None
+
+    return Forecast.load(os.path.join(WEATHER_DATA_DIR, run))
+
+
+def acquire_refresh_lock() -> bool:
+    """Try to become the worker that downloads new runs. The lock is released by the
+    operating system when the worker exits, so another worker takes over.
 
     Returns:
-        pd.DataFrame: The cached data if it exists, None otherwise
+        bool: Whether this worker holds the lock
     """
 
-    if not os.path.exists("weather_data"):
-        os.makedirs("weather_data")
+    global refresh_lock
 
-    # Get the date of the first file
-    date = today.date()
+    if refresh_lock is not None:
+        return True
 
-    # Check if the file exists
-    if os.path.exists(f"weather_data/{date}.csv"):
-        return pd.read_csv(f"weather_data/{date}.csv", index_col="datetime")
+    os.makedirs(WEATHER_DATA_DIR, exist_ok=True)
+    lock_file = open(os.path.join(WEATHER_DATA_DIR, ".refresh.lock"), "w")
+
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        return False
+
+    refresh_lock = lock_file
+
+    return True
 
-    # If the file does not exist, return None
-    return None
 
+def next_run_available(run: str) -> datetime | None:
+    """Estimate when the run after the given one becomes available.
 
-def get_predicted_data() -> pd.DataFrame:
-    """Get the predicted data for today and tomorrow.
+    Args:
+        run (str): The name of the file of the current run.
 
     Returns:
-        pd.DataFrame: The predicted data for today and tomorrow
+        datetime | None: The estimated time in UTC, None if the run name is not recognized
+    """
+
+    match = re.search(r"(\d{10})\.tar$", run)
+
+    if match is None:
+        return None
+
+    run_time = datetime.strptime(match.group(1), "%Y%m%d%H").replace(
+        tzinfo=timezone.utc
+    )
+
+    return run_time + timedelta(hours=24) + FORECAST_AVAILABILITY_DELAY
+
+
+async def refresh_forecast():
+    """Load the latest run of the HARMONIE model if it is newer than the published one.
+    The new forecast is built completely before it replaces the current one.
+    """
+
+    global forecast
+
+    api_key = os.getenv("KNMI_API_KEY")
+    # The connections to the API are pooled by the shared http client
+    api = OpenDataAPI(api_token=api_key)
+
+    latest_file = await find_latest_file(api)
+
+    if latest_file is None:
+        return
+
+    # Run names end with the date and hour of the run, so they compare chronologically
+    published = current_run()
+    if published is not None and published >= latest_file:
+        return
+
+    new_forecast = await forecast_flights.do(
+        latest_file, fetch_data_from_api, api, latest_file
+    )
+
+    # Swapping the reference is atomic, requests see either the old or the new run
+    forecast = new_forecast
+
+    logger.info(f"Serving forecast of {latest_file}")
+
+
+async def remap_forecast():
+    """Switch to the published run if another worker published a new one."""
+
+    global forecast
+
+    run = current_run()
+
+    if run is not None and (forecast is None or forecast.run != run):
+        forecast = await asyncio.to_thread(load_current_forecast)
+
+        logger.info(f"Serving forecast of {run}")
+
+
+async def refresh_forecast_periodically():
+    """Keep the forecast up to date. A single worker downloads new runs: after a run is
+    loaded it sleeps until the next run is expected, and from then on polls KNMI every
+    FORECAST_POLL_INTERVAL seconds. Every worker checks every FORECAST_WATCH_INTERVAL
+    seconds whether a new run was published and maps it.
     """
 
-    # Always get new data each day
-    today = datetime.now()
-    cached_data = get_cached_data(today)
+    next_poll = datetime.now(timezone.utc)
 
-    if cached_data is not None:
-        logger.info(f"Using cached data for {today.date()}")
-        return cached_data
+    while True:
+        if datetime.now(timezone.utc) >= next_poll and acquire_refresh_lock():
+            try:
+                await refresh_forecast()
+            except Exception:
+                logger.exception("Unable to refresh the weather forecast")
+
+            next_poll = datetime.now(timezone.utc) + timedelta(
+                seconds=FORECAST_POLL_INTERVAL
+            )
 
-    logger.info("Fetching data from the KNMI API")
+            run = current_run()
+            available = next_run_available(run) if run is not None else None
+
+            if available is not None:
+                next_poll = max(next_poll, available)
+
+        try:
+            await remap_forecast()
+        except Exception:
+            logger.exception("Unable to map the weather forecast")
+
+        await asyncio.sleep(FORECAST_WATCH_INTERVAL)
+
+
+async def load_forecast_store():
+    global forecast, refresh_task
+
+    # A published run is mapped right away, so a cold worker serves forecasts immediately.
+    # The leader can prune the run between reading the pointer and mapping the cube, in
+    # which case the refresh task maps the new run on its first check.
+    try:
+        forecast = await asyncio.to_thread(load_current_forecast)
+    except FileNotFoundError:
+        logger.exception("Unable to map the weather forecast")
+        forecast = None
+
+    if forecast is not None:
+        logger.info(f"Serving cached forecast of {forecast.run}")
+
+    refresh_task = asyncio.create_task(refresh_forecast_periodically())
+
+
+async def unload_forecast_store():
+    global forecast, refresh_task, refresh_lock
+
+    refresh_task.cancel()
+
+    try:
+        await refresh_task
+    except asyncio.CancelledError:
+        pass
+
+    forecast = None
+    refresh_task = None
+
+    if refresh_lock is not None:
+        refresh_lock.close()
+        refresh_lock = None
+
+
+def get_predicted_data() -> Forecast | None:
+    """Get the predicted data for today and tomorrow. The forecast is kept up to date by
+    a background task, so this never waits on KNMI.
+
+    Returns:
+        Forecast | None: The latest forecast, None if no forecast was loaded yet
+    """
 
-    return fetch_data_from_api()
+    return forecast